@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+
+"""
+Asyncio based engine for experiments having many concurrent commands
+
+AsyncExp runs the commands of an experiment as asyncio subprocesses from a
+single thread, so thousands of commands (e.g., clients of a load generation
+experiment) can run together without a thread or a polling loop for each.
+Outputs of the commands are streamed line by line with the name of the command
+as the prefix, unless the experiment has its logs directory.  Each command
+runs in its own process group, so that it can be terminated with its children
+when its timeout passes, or the experiment ends.
+"""
+
+import asyncio
+import os
+import signal
+import sys
+import threading
+import time
+
+import exp
+import proctree
+
+watcher_lock = threading.Lock()
+watcher_set = False
+
+def setup_child_watcher():
+    """Make asyncio wait for the commands using pidfd instead of a thread for
+    each command.  Python 3.12 and later do so by default.  Before 3.12, the
+    pidfd watcher serves only one loop, attached by set_event_loop() of the
+    main thread, so experiments running in other threads, e.g., for --jobs,
+    keep the default watcher, which works with the loop of any thread."""
+    global watcher_set
+    with watcher_lock:
+        if watcher_set:
+            return
+        watcher_set = True
+        if sys.version_info >= (3, 12):
+            return
+        if threading.current_thread() is not threading.main_thread():
+            # create the default watcher once, not racing in each thread
+            asyncio.get_child_watcher()
+            return
+        if not hasattr(asyncio, 'PidfdChildWatcher'):
+            return
+        pidfd = proctree.pidfd_of(os.getpid())
+        if pidfd == None:
+            return
+        os.close(pidfd)
+        asyncio.set_child_watcher(asyncio.PidfdChildWatcher())
+
+def signal_group(pgid, sigs):
+    for sig in sigs:
+        try:
+            os.killpg(pgid, sig)
+        except OSError:
+            pass
+
+class AsyncTask:
+    """A running command.  'name' is '<type>-<index>', followed by
+    '.<instance>' if multiple instances of the command run."""
+    cmd = None
+    phase = None
+    index = None
+    name = None
+    instance = None
+    proc = None
+    pid = None
+    streams = []
+    start_ns = None
+    end_ns = None
+    timed_out = False
+
+    def __init__(self, cmd, phase, index, name, instance, proc, streams):
+        self.cmd = cmd
+        self.phase = phase
+        self.index = index
+        self.name = name
+        self.instance = instance
+        self.proc = proc
+        self.pid = proc.pid
+        self.streams = streams
+        self.start_ns = time.monotonic_ns()
+
+async def stream(reader, prefix, out):
+    "Copy lines from the reader to the output file, prefixing each line"
+    async for line in reader:
+        out.write(prefix + line)
+        out.flush()
+
+def close_loop(loop):
+    "Cancel remaining tasks and close the event loop, as asyncio.run() does"
+    pending = asyncio.all_tasks(loop)
+    for task in pending:
+        task.cancel()
+    if len(pending) > 0:
+        loop.run_until_complete(asyncio.gather(*pending,
+            return_exceptions=True))
+    loop.run_until_complete(loop.shutdown_asyncgens())
+    loop.run_until_complete(loop.shutdown_default_executor())
+    loop.close()
+
+class AsyncExp(exp.Exp):
+    """An experiment running the commands as asyncio subprocesses.  The phases
+    are run by exp.Exp, while the event loop runs until the commands of each
+    step are spawned or terminated."""
+    # AsyncTasks of the running commands
+    tasks = []
+    # AsyncTasks of the background and the main commands to their waits
+    waits = {}
+    loop = None
+
+    def __str__(self):
+        return exp.Exp.__str__(self)[:-1] + "  engine: async\n}"
+
+    def argv(self, cmd, opts, env):
+        "Returns the arguments to exec for the command"
+        cpus = opts.get('cpus', self.cpus)
+        args = exp.wrapper_args(self.cgroup,
+                exp.parse_cpulist(cpus) if cpus != None else exp.default_cpus,
+                opts.get('mems', self.mems), opts.get('sched'))
+        direct_args = exp.exec_args(cmd, opts.get('shell'), env)
+        if direct_args != None:
+            return args + direct_args
+        return args + ['/bin/bash', '-c', cmd]
+
+    async def spawn(self, cmd, phase, index, env=None, instances=None):
+        """Start the instances of the command, or only the given instances.
+        Returns AsyncTasks for those."""
+        opts = self.cmd_opts.get((phase, index), {})
+        nr = int(opts.get('nr', 1))
+        if instances == None:
+            instances = range(nr)
+        ret = []
+        for instance in instances:
+            name = '%s-%d' % (phase, index)
+            if nr > 1:
+                name += '.%d' % instance
+            if self.logspool != None:
+                stdout, stderr = self.logspool.open(name, cmd, phase)
+            else:
+                stdout = asyncio.subprocess.PIPE
+                stderr = asyncio.subprocess.PIPE
+            try:
+                proc = await asyncio.create_subprocess_exec(
+                        *self.argv(cmd, opts, env), stdout=stdout,
+                        stderr=stderr, start_new_session=True, env=env)
+            finally:
+                if self.logspool != None:
+                    stdout.close()
+                    stderr.close()
+            streams = []
+            if self.logspool == None:
+                prefix = ('[%s] ' % name).encode()
+                streams = [asyncio.ensure_future(stream(proc.stdout, prefix,
+                    sys.stdout.buffer)),
+                    asyncio.ensure_future(stream(proc.stderr, prefix,
+                        sys.stderr.buffer))]
+            self.record('spawn', phase=phase, cmd=cmd, pid=proc.pid)
+            task = AsyncTask(cmd, phase, index, name, instance, proc,
+                    streams)
+            self.tasks.append(task)
+            ret.append(task)
+        return ret
+
+    async def kill(self, task):
+        """Send INT, TERM and then KILL to the process group of the task, until
+        the command terminates"""
+        pgid = task.proc.pid
+        for sigs, grace in [[[signal.SIGINT, signal.SIGCONT], exp.int_grace],
+                [[signal.SIGTERM], exp.term_grace]]:
+            signal_group(pgid, sigs)
+            try:
+                await asyncio.wait_for(asyncio.shield(task.proc.wait()), grace)
+                return
+            except asyncio.TimeoutError:
+                pass
+        signal_group(pgid, [signal.SIGKILL])
+        await task.proc.wait()
+
+    async def wait(self, task):
+        """Wait for the termination of the task, killing it if its timeout
+        passes.  Returns the task."""
+        timeout = self.cmd_opts.get((task.phase, task.index), {}).get(
+                'timeout')
+        try:
+            await asyncio.wait_for(asyncio.shield(task.proc.wait()),
+                    float(timeout) if timeout != None else None)
+        except asyncio.TimeoutError:
+            if not exp.silence:
+                print(exp.ltime(), "%s (%s) timed out" % (task.cmd,
+                    task.proc.pid))
+            task.timed_out = True
+            await self.kill(task)
+        await asyncio.gather(*task.streams)
+        task.end_ns = time.monotonic_ns()
+        self.tasks.remove(task)
+        self.record('exit', phase=task.phase, pid=task.proc.pid,
+                returncode=task.proc.returncode, start_ns=task.start_ns,
+                end_ns=task.end_ns, runtime_ns=task.end_ns - task.start_ns,
+                timeout=task.timed_out)
+        return task
+
+    async def call_async(self, cmd, phase, index, env=None):
+        """Run the instances of the command and wait for those.  Returns the
+        first non-zero exit code of the instances, or zero."""
+        tasks = await self.spawn(cmd, phase, index, env)
+        ret = 0
+        for task in await asyncio.gather(*[self.wait(t) for t in tasks]):
+            if ret == 0:
+                ret = task.proc.returncode
+        return ret
+
+    async def call_all(self, cmds, phase):
+        "Run the commands together, and wait for those"
+        await asyncio.gather(*[self.call_async(cmd, phase, index)
+            for index, cmd in enumerate(cmds)])
+
+    def call(self, cmd, phase, index, env=None):
+        return self.loop.run_until_complete(self.call_async(cmd, phase, index,
+            env))
+
+    def spawn_waited(self, cmd, phase, index, instances=None):
+        """Start the instances of the command, and wait for those in
+        background.  Returns AsyncTasks for those."""
+        tasks = self.loop.run_until_complete(self.spawn(cmd, phase, index,
+            instances=instances))
+        for task in tasks:
+            self.waits[task] = self.loop.create_task(self.wait(task))
+        return tasks
+
+    def reset_tasks(self):
+        self.tasks = []
+        self.waits = {}
+
+    def spawn_back(self, cmd, index):
+        self.spawn_waited(cmd, 'back', index)
+
+    def run_warmups(self):
+        self.loop.run_until_complete(self.call_all(self.warmup_cmds,
+            'warmup'))
+
+    def spawn_main(self, cmd, index):
+        return self.spawn_waited(cmd, 'main', index)
+
+    def respawn_main(self, task):
+        return self.spawn_waited(task.cmd, 'main', task.index,
+                instances=[task.instance])[0]
+
+    def wait_main(self, tasks):
+        done, pending = self.loop.run_until_complete(asyncio.wait(
+            [self.waits[t] for t in tasks],
+            return_when=asyncio.FIRST_COMPLETED))
+        return [wait.result() for wait in done]
+
+    def main_pids(self):
+        return [t.pid for t in self.tasks if t.phase == 'main']
+
+    async def terminate(self):
+        await asyncio.gather(*[self.kill(t) for t in self.tasks])
+        await asyncio.gather(*self.waits.values())
+
+    def terminate_workload(self):
+        if not exp.silence:
+            print(exp.ltime(), "terminate tasks of exp %s" % self)
+        self.loop.run_until_complete(self.terminate())
+
+    def terminate_tasks(self):
+        """Send the termination signals to the running commands, for signals.
+        The event loop could be running, so the commands are not reaped."""
+        if not exp.silence:
+            print(exp.ltime(), "terminate tasks of exp %s" % self)
+        self.kill_running()
+
+    def kill_stage(self, tasks, stages):
+        """Send the signals of the first stage to the process groups of the
+        commands, and the signals of the next stages after their grace periods
+        to the survivors.  On the watchdog thread, the next stage is scheduled
+        on the watchdog, so that other timers are not delayed."""
+        sigs, grace = stages[0]
+        tasks = [t for t in tasks if t.proc.returncode == None and
+                proctree.alive(t.pid)]
+        for task in tasks:
+            signal_group(task.pid, sigs)
+        if len(stages) == 1 or len(tasks) == 0:
+            return
+        watchdog = self.watchdog
+        if watchdog != None and threading.current_thread() is watchdog:
+            watchdog.add(grace, lambda: self.kill_stage(tasks, stages[1:]))
+            return
+        time.sleep(grace)
+        self.kill_stage(tasks, stages[1:])
+
+    def kill_running(self):
+        """Send the termination signals to the running commands without the
+        event loop, for signals and timeouts"""
+        self.kill_stage(list(self.tasks), [
+            [[signal.SIGINT, signal.SIGCONT], exp.int_grace],
+            [[signal.SIGTERM], exp.term_grace], [[signal.SIGKILL], None]])
+
+    def execute_cmds(self):
+        setup_child_watcher()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            return exp.Exp.execute_cmds(self)
+        finally:
+            close_loop(self.loop)
+            asyncio.set_event_loop(None)
+            self.loop = None
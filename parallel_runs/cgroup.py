@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+"Manage cgroup v2 for experiments"
+
+import itertools
+import os
+import select
+import signal
+import time
+
+ROOT_CANDIDATES = ['/sys/fs/cgroup', '/sys/fs/cgroup/unified']
+PARENT = 'lazybox'
+CONTROLLERS = ['cpu', 'memory', 'io']
+
+ids = itertools.count()
+
+def find_root():
+    "Returns the mount point of cgroup v2, or None if it is not mounted"
+    for path in ROOT_CANDIDATES:
+        if os.path.isfile(os.path.join(path, 'cgroup.controllers')):
+            return path
+    return None
+
+def read(cgroup, filename):
+    try:
+        with open(os.path.join(cgroup, filename), 'r') as f:
+            return f.read()
+    except OSError:
+        return None
+
+def write(cgroup, filename, content):
+    "Returns True if the write succeeded"
+    try:
+        with open(os.path.join(cgroup, filename), 'w') as f:
+            f.write(content)
+    except OSError:
+        return False
+    return True
+
+def create():
+    """Create a new cgroup for an experiment and returns its path, or None if
+    cgroup v2 is not available"""
+    root = find_root()
+    if root == None:
+        return None
+    parent = os.path.join(root, PARENT)
+    path = os.path.join(parent, 'run_exps-%d-%d' % (os.getpid(), next(ids)))
+    try:
+        os.makedirs(parent, exist_ok=True)
+        # Enable controllers for the accounting.  This could fail if the
+        # controller is used by cgroup v1, but the cgroup is still usable for
+        # the termination.
+        for cgroup in [root, parent]:
+            for controller in CONTROLLERS:
+                write(cgroup, 'cgroup.subtree_control', '+%s' % controller)
+        os.mkdir(path)
+    except OSError:
+        return None
+    return path
+
+def destroy(cgroup):
+    wait_empty(cgroup, 1)
+    try:
+        os.rmdir(cgroup)
+    except OSError:
+        pass
+
+def enter_args(cgroup):
+    """Returns arguments to prefix a command with, for executing the command
+    in the cgroup.  The command is executed even if entering the cgroup
+    failed, e.g., because the cgroup is removed.  Callers should terminate
+    processes that failed entering the cgroup by themselves."""
+    return ['/bin/sh', '-c',
+            'echo 0 > "$0/cgroup.procs" 2> /dev/null; exec "$@"', cgroup]
+
+def procs(cgroup):
+    content = read(cgroup, 'cgroup.procs')
+    if content == None:
+        return []
+    return [int(p) for p in content.split()]
+
+def populated(cgroup):
+    content = read(cgroup, 'cgroup.events')
+    if content == None:
+        return False
+    for line in content.split('\n'):
+        fields = line.split()
+        if len(fields) == 2 and fields[0] == 'populated':
+            return fields[1] == '1'
+    return False
+
+def wait_empty(cgroup, timeout):
+    """Wait until every process of the cgroup exits, or the timeout (seconds)
+    passes.  Returns True if the cgroup became empty."""
+    deadline = time.monotonic() + timeout
+    try:
+        fd = os.open(os.path.join(cgroup, 'cgroup.events'), os.O_RDONLY)
+    except OSError:
+        return not populated(cgroup)
+    try:
+        # cgroup.events generates POLLPRI on changes
+        poller = select.poll()
+        poller.register(fd, select.POLLPRI)
+        while populated(cgroup):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            poller.poll(remaining * 1000)
+    finally:
+        os.close(fd)
+    return True
+
+def signal_all(cgroup, sig):
+    """Send the signal to every process in the cgroup.  The cgroup is frozen
+    while sending the signals, so that no new process escapes."""
+    frozen = write(cgroup, 'cgroup.freeze', '1')
+    for pid in procs(cgroup):
+        try:
+            os.kill(pid, sig)
+        except OSError:
+            pass
+    if frozen:
+        write(cgroup, 'cgroup.freeze', '0')
+
+def kill(cgroup):
+    "SIGKILL every process in the cgroup"
+    if write(cgroup, 'cgroup.kill', '1'):
+        return
+    signal_all(cgroup, signal.SIGKILL)
+
+def terminate(cgroup, int_grace=0.5, term_grace=0.1):
+    """Send INT, TERM, and then KILL to the processes of the cgroup, as
+    exp.kill_childs_self() does, but to all processes at once.  'int_grace' and
+    'term_grace' are seconds to wait for the termination after INT and TERM."""
+    signal_all(cgroup, signal.SIGINT)
+    signal_all(cgroup, signal.SIGCONT)
+    if wait_empty(cgroup, int_grace):
+        return
+    signal_all(cgroup, signal.SIGTERM)
+    if wait_empty(cgroup, term_grace):
+        return
+    kill(cgroup)
+    wait_empty(cgroup, 1)
+
+def read_kv(cgroup, filename):
+    "Read flat keyed file (e.g., cpu.stat) into a dict"
+    content = read(cgroup, filename)
+    if content == None:
+        return None
+    ret = {}
+    for line in content.split('\n'):
+        fields = line.split()
+        if len(fields) == 2:
+            ret[fields[0]] = int(fields[1])
+    return ret
+
+def read_io_stat(cgroup):
+    "Read io.stat into a dict of device to its keyed stats"
+    content = read(cgroup, 'io.stat')
+    if content == None:
+        return None
+    ret = {}
+    for line in content.split('\n'):
+        fields = line.split()
+        if len(fields) == 0:
+            continue
+        ret[fields[0]] = {}
+        for field in fields[1:]:
+            key, val = field.split('=')
+            ret[fields[0]][key] = int(val)
+    return ret
+
+def stat(cgroup):
+    "Returns resource usage of the cgroup, for available controllers only"
+    ret = {}
+    cpu_stat = read_kv(cgroup, 'cpu.stat')
+    if cpu_stat != None:
+        ret['cpu.stat'] = cpu_stat
+    memory_peak = read(cgroup, 'memory.peak')
+    if memory_peak != None:
+        ret['memory.peak'] = int(memory_peak)
+    io_stat = read_io_stat(cgroup)
+    if io_stat != None:
+        ret['io.stat'] = io_stat
+    return ret
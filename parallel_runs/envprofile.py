@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+"""
+Apply, verify and restore system settings for experiments
+
+An environment profile is a JSON tree of files and values to write, in the
+format of scripts/fs.py, rooted at '/'.  For example,
+
+    {"sys": {"kernel": {"mm": {"transparent_hugepage": {"enabled": "never"}}}},
+     "proc": {"sys": {"vm": {"drop_caches": "3"}}}}
+
+Files are written in the order of the tree.  A list of trees can be used to
+write a file multiple times.
+"""
+
+import json
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+    '..', 'scripts'))
+import fs
+
+def load(profile):
+    "Load a profile from a JSON string, or a JSON file"
+    if profile.lstrip().startswith('{') or profile.lstrip().startswith('['):
+        return json.loads(profile)
+    with open(profile, 'r') as f:
+        return json.load(f)
+
+def settings_of(root, contents):
+    "Returns [path, value] list of the profile, in the order of writes"
+    if isinstance(contents, list):
+        ret = []
+        for c in contents:
+            ret += settings_of(root, c)
+        return ret
+    ret = []
+    for filename in contents:
+        path = os.path.join(root, filename)
+        if isinstance(contents[filename], str):
+            ret.append([path, contents[filename]])
+        else:
+            ret += settings_of(path, contents[filename])
+    return ret
+
+def read_value(path):
+    """Returns current value of the file, or None if it is not readable.  For
+    files showing the selected one among the choices like
+    'always [madvise] never', returns the selected one."""
+    try:
+        with open(path, 'r') as f:
+            value = f.read().strip()
+    except Exception:
+        return None
+    if '[' in value and ']' in value:
+        return value[value.index('[') + 1:value.index(']')]
+    return value
+
+def apply(profile):
+    """Apply the profile and returns previous values of the files, effective
+    values of the files, and files having values different from the profile"""
+    settings = settings_of('/', profile)
+    previous = {}
+    for path, value in settings:
+        if not path in previous:
+            previous[path] = read_value(path)
+    fs.write_fs('/', profile)
+    effective = {}
+    expected = {}
+    for path, value in settings:
+        effective[path] = read_value(path)
+        expected[path] = value.strip()
+    # write-only files like drop_caches cannot be verified
+    mismatches = [p for p in expected
+            if effective[p] != None and effective[p] != expected[p]]
+    return previous, effective, mismatches
+
+def restore(previous):
+    "Restore the values returned by apply()"
+    contents = {}
+    for path, value in previous.items():
+        if value == None:
+            continue
+        contents[path.lstrip('/')] = value
+    fs.write_fs('/', contents)
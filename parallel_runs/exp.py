@@ -8,24 +8,238 @@ __copyright__ = "Copyright (c) 2013-2020, SeongJae Park"
 __license__ = "GPLv2"
 
 import datetime
+import hashlib
 import os
+import select
+import shlex
+import shutil
 import signal
 import subprocess
 import time
 
+import cgroup
+import envprofile
+import journal
+import logspool
+import proctree
+import sampler
+import watchdog
+
 silence = False
+# Run each experiment in its own cgroup v2 if available
+use_cgroup = True
 
 def ltime():
     return datetime.datetime.now().strftime("[%H:%M:%S] ")
 
+# Fields of os.wait4() rusage to record for each command
+RUSAGE_FIELDS = ['ru_utime', 'ru_stime', 'ru_maxrss', 'ru_minflt', 'ru_majflt',
+        'ru_inblock', 'ru_oublock', 'ru_nvcsw', 'ru_nivcsw']
+
+def wait4(popn, nonblock=False):
+    """Reap the process using os.wait4() and returns its rusage as a dict.
+    Returns None if the process is not terminated yet (for 'nonblock'), or is
+    already reaped."""
+    if popn.returncode != None:
+        return None
+    try:
+        pid, status, ru = os.wait4(popn.pid, os.WNOHANG if nonblock else 0)
+    except ChildProcessError:
+        popn.poll()
+        return None
+    if pid == 0:
+        return None
+    popn.returncode = os.waitstatus_to_exitcode(status)
+    return {field[3:]: getattr(ru, field) for field in RUSAGE_FIELDS}
+
 class Task:
+    """A main command, which is spawned again by set_popn() for the 'respawn'
+    policy.  'name' is 'main-<index>'."""
     cmd = None
+    # index of the command in the main commands of the exp
+    index = None
+    name = None
     popn = None
-    completed = False
+    pid = None
+    pidfd = None
+    # time.monotonic_ns() at the spawn and the reap of the process, and its
+    # rusage from os.wait4()
+    start_ns = None
+    end_ns = None
+    rusage = None
+    # number of the runs of the command
+    nr_runs = 0
+    # whether the last run is killed by the 'timeout' option of the command
+    timed_out = False
 
-    def __init__(self, cmd, popn):
+    def __init__(self, cmd, index, popn):
         self.cmd = cmd
+        self.index = index
+        self.name = 'main-%d' % index
+        self.set_popn(popn)
+
+    def set_popn(self, popn):
+        self.close_pidfd()
         self.popn = popn
+        self.pid = popn.pid
+        self.pidfd = proctree.pidfd_of(popn.pid)
+        self.start_ns = time.monotonic_ns()
+        self.end_ns = None
+        self.rusage = None
+        self.timed_out = False
+        self.nr_runs += 1
+
+    def close_pidfd(self):
+        if self.pidfd != None:
+            os.close(self.pidfd)
+            self.pidfd = None
+
+    def poll(self):
+        "Reap the process if it is terminated.  Returns True if terminated."
+        if self.popn.returncode == None:
+            self.rusage = wait4(self.popn, True)
+        if self.popn.returncode == None:
+            return False
+        if self.end_ns == None:
+            self.end_ns = time.monotonic_ns()
+        return True
+
+    def reap(self, timeout=1):
+        "Wait a while for the terminated process.  Returns True if reaped."
+        deadline = time.monotonic() + timeout
+        while not self.poll():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if self.pidfd != None:
+                select.select([self.pidfd], [], [], remaining)
+            else:
+                time.sleep(min(remaining, 0.01))
+        return True
+
+    def timing(self):
+        "Returns the timestamps, runtime and rusage of the terminated process"
+        ret = {'start_ns': self.start_ns, 'end_ns': self.end_ns,
+                'rusage': self.rusage}
+        if self.end_ns != None:
+            ret['runtime_ns'] = self.end_ns - self.start_ns
+        return ret
+
+def parse_cpulist(cpulist):
+    "Parse cpulist format string (e.g., '0-3,8') into a set of numbers"
+    ret = set()
+    for field in cpulist.split(','):
+        field = field.strip()
+        if field == '':
+            continue
+        if '-' in field:
+            start, end = field.split('-')
+            ret.update(range(int(start), int(end) + 1))
+        else:
+            ret.add(int(field))
+    return ret
+
+# Execute commands having no shell syntax directly, without bash
+direct_exec = False
+
+SHELL_CHARS = set('|&;<>()$`\\*?[]{}~#!\n')
+# Words that bash handles by itself, even if executables of the names exist
+SHELL_WORDS = ['time', 'exec', 'command', 'builtin', 'eval', 'source', '.']
+
+def exec_args(cmd, shell=None, env=None):
+    """Returns arguments to directly execute the command, or None if the
+    command should be executed by bash.  'shell' is the 'shell' option of the
+    command.  'yes' means bash, 'no' means direct execution, and 'auto' means
+    direct execution if the command has no shell syntax and the program is
+    found.  None means 'auto' if direct_exec is set, or 'yes' otherwise."""
+    if shell == None:
+        shell = 'auto' if direct_exec else 'yes'
+    if shell == 'yes':
+        return None
+    if shell == 'no':
+        return shlex.split(cmd)
+    if len(SHELL_CHARS & set(cmd)) > 0:
+        return None
+    try:
+        args = shlex.split(cmd)
+    except ValueError:
+        return None
+    if len(args) == 0 or '=' in args[0] or args[0] in SHELL_WORDS:
+        return None
+    path = env.get('PATH') if env != None else None
+    if shutil.which(args[0], path=path) == None:
+        return None
+    return args
+
+# CPUs to run commands having no cpus specified on.  None means inheriting
+# affinity of run_exps.py.
+default_cpus = None
+
+SCHED_POLICIES = {'other': os.SCHED_OTHER, 'batch': os.SCHED_BATCH,
+        'idle': os.SCHED_IDLE, 'fifo': os.SCHED_FIFO, 'rr': os.SCHED_RR}
+
+def parse_sched(sched):
+    """Parse '<policy>[/<priority>]' into the policy and the priority.  The
+    priority is mandatory for the realtime policies, and should be in the
+    range of the policy."""
+    fields = sched.split('/')
+    if not fields[0] in SCHED_POLICIES:
+        raise ValueError('unknown sched policy %s' % fields[0])
+    policy = SCHED_POLICIES[fields[0]]
+    if len(fields) == 1 and policy in [os.SCHED_FIFO, os.SCHED_RR]:
+        raise ValueError('sched policy %s needs a priority' % fields[0])
+    prio = int(fields[1]) if len(fields) > 1 else 0
+    min_prio = os.sched_get_priority_min(policy)
+    max_prio = os.sched_get_priority_max(policy)
+    if prio < min_prio or prio > max_prio:
+        raise ValueError('priority of sched policy %s should be in %d-%d' %
+                (fields[0], min_prio, max_prio))
+    return policy, prio
+
+SCHED_OPTS = {os.SCHED_OTHER: '--other', os.SCHED_BATCH: '--batch',
+        os.SCHED_IDLE: '--idle', os.SCHED_FIFO: '--fifo', os.SCHED_RR: '--rr'}
+
+def wrapper_args(cgroup_path, cpus, mems, sched):
+    """Returns arguments to prefix a command with, for executing the command
+    in the cgroup, on the cpus and mems, and with the scheduling policy.
+    Wrappers set those instead of preexec_fn, which is unsafe in the presence
+    of threads."""
+    args = []
+    if cgroup_path != None:
+        args += cgroup.enter_args(cgroup_path)
+    if sched != None:
+        policy, prio = parse_sched(sched)
+        args += ['chrt', SCHED_OPTS[policy], '%d' % prio]
+    if cpus != None:
+        args += ['taskset', '--cpu-list',
+                ','.join(['%d' % cpu for cpu in sorted(cpus)])]
+    if mems != None:
+        args += ['numactl', '--membind=%s' % mems]
+    return args
+
+def wait_tasks(tasks):
+    """Wait until at least one of the tasks terminates and returns terminated
+    tasks.  If every task has a pidfd, sleep on those without periodic wakeup.
+    Otherwise, fallback to polling."""
+    while True:
+        terminated = [t for t in tasks if t.poll()]
+        if len(terminated) > 0:
+            return terminated
+        if None in [t.pidfd for t in tasks]:
+            time.sleep(0.5)
+            continue
+        poller = select.poll()
+        for task in tasks:
+            poller.register(task.pidfd, select.POLLIN)
+        poller.poll()
+
+def reap(popn):
+    "Wait a while for the terminated process.  Returns True if reaped."
+    try:
+        popn.wait(1)
+    except subprocess.TimeoutExpired:
+        return False
+    return True
 
 def linebreak(cmd, nr_cols):
     if len(cmd) < nr_cols or len(cmd.split()) == 1:
@@ -54,111 +268,596 @@ class Exp:
     main_cmds = []
     back_cmds = []
     check_cmds = []
+    # Commands run to completion before the main commands, and commands run
+    # at the begin and the end of the measurement window, i.e., main commands
+    warmup_cmds = []
+    measure_cmds = []
+
+    # Per-command cpus, mems and sched options, keyed by [type, index]
+    cmd_opts = {}
+
+    # What to do when a main command terminates while others are running.
+    # 'respawn' runs it again until every main command terminates once,
+    # 'wait-all' waits for the others, and 'stop-on-first' ends the main phase.
+    main_policy = 'respawn'
 
     main_tasks = []
     back_procs = []
+    warmup_procs = []
+    # Counters snapshot at the begin and the end of the measurement window
+    window = None
+
+    # CPUs and memory nodes to run the commands on, and a name of a resource
+    # that should not be shared with other concurrently running experiments
+    cpus = None
+    mems = None
+    slot = None
+
+    cgroup = None
+    cgroup_stat = None
+
+    # Interval (seconds) and output file of resource usage sampling for the
+    # process trees of the main tasks
+    sample_interval = None
+    sample_file = None
+
+    # Max number of attempts, seconds to wait before the first retry (doubled
+    # for each retry), and check exit codes to retry for.  None means the
+    # default of run_exps.py, or any code for retry_codes.
+    retry_limit = None
+    retry_backoff = None
+    retry_codes = None
+
+    # [check command, its exit code] that made the last execution fail
+    failure = None
+
+    # Cache of digest()
+    hash_digest = None
+
+    # Directory to save outputs of the commands, max size of each log file,
+    # and number of rotated log files to keep
+    logs_dir = None
+    log_max_bytes = None
+    log_rotations = 0
+    logspool = None
 
-    def __init__(self, start, main, back, end, check):
+    # Environment profile (a JSON file or string) to apply before the
+    # experiment, and previous values of the files to restore after that
+    env_profile = None
+    env_previous = None
+
+    # Seconds to wait for each phase (e.g., 'main') or the whole experiment
+    # ('exp') before killing the commands, keyed by the phase
+    timeouts = {}
+    watchdog = None
+    phase_timer = None
+    current_phase = None
+    # [phase or 'exp' that timed out, the phase at the time], or None
+    timed_out = None
+    # command that is executed by call(), and timers of command timeouts
+    called = None
+    cmd_timers = {}
+    timed_out_pids = set()
+
+    def __init__(self, start, main, back, end, check, cpus=None, mems=None,
+            slot=None, sample_interval=None, sample_file=None,
+            retry_limit=None, retry_backoff=None, retry_codes=None,
+            logs_dir=None, log_max_bytes=None, log_rotations=0, warmup=[],
+            measure=[], cmd_opts={}, env_profile=None, timeouts={},
+            main_policy='respawn'):
         self.start_cmds = start
         self.end_cmds = end
         self.main_cmds = main
         self.back_cmds = back
         self.check_cmds = check
+        self.cpus = cpus
+        self.mems = mems
+        self.slot = slot
+        self.sample_interval = sample_interval
+        self.sample_file = sample_file
+        self.retry_limit = retry_limit
+        self.retry_backoff = retry_backoff
+        self.retry_codes = retry_codes
+        self.logs_dir = logs_dir
+        self.log_max_bytes = log_max_bytes
+        self.log_rotations = log_rotations
+        self.warmup_cmds = warmup
+        self.measure_cmds = measure
+        self.cmd_opts = cmd_opts
+        self.env_profile = env_profile
+        self.timeouts = timeouts
+        self.main_policy = main_policy
 
     def __str__(self):
-        return "{\n  start:\n%s\n  main:\n%s\n  back:\n%s\n  end:\n%s\n  check:\n%s\n}" % (
+        ret = "{\n  start:\n%s\n  main:\n%s\n  back:\n%s\n  end:\n%s\n  check:\n%s\n" % (
                 pretty(self.start_cmds), pretty(self.main_cmds),
                 pretty(self.back_cmds), pretty(self.end_cmds),
                 pretty(self.check_cmds))
+        for name, cmds in [['warmup', self.warmup_cmds],
+                ['measure', self.measure_cmds]]:
+            if len(cmds) > 0:
+                ret += "  %s:\n%s\n" % (name, pretty(cmds))
+        for name, val in [['cpus', self.cpus], ['mems', self.mems],
+                ['slot', self.slot]]:
+            if val != None:
+                ret += "  %s: %s\n" % (name, val)
+        if self.sample_file != None:
+            ret += "  sample: %s %s\n" % (self.sample_interval,
+                    self.sample_file)
+        if self.retry_limit != None:
+            ret += "  retry: %s %s %s\n" % (self.retry_limit,
+                    self.retry_backoff, self.retry_codes)
+        if self.logs_dir != None:
+            ret += "  logs: %s %s %s\n" % (self.logs_dir, self.log_max_bytes,
+                    self.log_rotations)
+        if self.env_profile != None:
+            ret += "  env: %s\n" % self.env_profile
+        if self.main_policy != 'respawn':
+            ret += "  main_policy: %s\n" % self.main_policy
+        if len(self.timeouts) > 0:
+            ret += "  timeouts: %s\n" % ' '.join(['%s=%s' % (k, v)
+                for k, v in sorted(self.timeouts.items())])
+        for phase, index in sorted(self.cmd_opts):
+            ret += "  %s options: %s\n%s\n" % (phase, ' '.join(
+                ['%s=%s' % (k, v) for k, v in sorted(
+                    self.cmd_opts[(phase, index)].items())]),
+                pretty([self.cmds_of(phase)[index]], 2))
+        return ret + "}"
 
     def __repr__(self):
         return self.__str__()
 
+    def digest(self):
+        "Returns a hash of the commands of this exp"
+        if self.hash_digest == None:
+            self.hash_digest = hashlib.sha1(
+                    self.__str__().encode('utf-8')).hexdigest()
+        return self.hash_digest
+
+    def record(self, event, **fields):
+        "Record the event of this exp in the journal, if it is opened"
+        if journal.journal_file == None:
+            return
+        journal.record(event, exp=self.digest(), **fields)
+
+    def retryable(self):
+        "Returns True if the last failure should be retried"
+        if self.retry_codes == None or self.failure == None:
+            return True
+        return self.failure[1] in self.retry_codes
+
+    def conflicts(self, other):
+        "Returns True if this and the other exp cannot run concurrently"
+        if self.slot != None and self.slot == other.slot:
+            return True
+        # profiles change system-wide settings, which restores would mix up
+        if self.env_profile != None or other.env_profile != None:
+            return True
+        if self.cpus == None or other.cpus == None:
+            return True
+        return len(parse_cpulist(self.cpus) & parse_cpulist(other.cpus)) > 0
+
+    def cmds_of(self, phase):
+        "Returns the commands of the type, e.g., 'start'"
+        return {'start': self.start_cmds, 'main': self.main_cmds,
+                'back': self.back_cmds, 'end': self.end_cmds,
+                'check': self.check_cmds, 'warmup': self.warmup_cmds,
+                'measure': self.measure_cmds}[phase]
+
+    def popen(self, cmd, phase, index, env=None):
+        """Start a command of this exp on the cpus and mems of the command, or
+        of this exp.  'phase' is the type of the command, e.g., 'start', and
+        'index' is the index of the command in the commands of the type."""
+        opts = self.cmd_opts.get((phase, index), {})
+        cpus = opts.get('cpus', self.cpus)
+        args = wrapper_args(self.cgroup,
+                parse_cpulist(cpus) if cpus != None else default_cpus,
+                opts.get('mems', self.mems), opts.get('sched'))
+        stdout = None
+        stderr = None
+        if self.logspool != None:
+            stdout, stderr = self.logspool.open('%s-%d' % (phase, index),
+                    cmd, phase)
+        direct_args = exec_args(cmd, opts.get('shell'), env)
+        try:
+            if direct_args != None:
+                popn = subprocess.Popen(args + direct_args, stdout=stdout,
+                        stderr=stderr, env=env)
+            elif len(args) == 0:
+                popn = subprocess.Popen(cmd, shell=True,
+                        executable="/bin/bash", stdout=stdout, stderr=stderr,
+                        env=env)
+            else:
+                popn = subprocess.Popen(args + ['/bin/bash', '-c', cmd],
+                        stdout=stdout, stderr=stderr, env=env)
+        finally:
+            # the command has its own copies of the fds
+            if stdout != None:
+                stdout.close()
+                stderr.close()
+        self.record('spawn', phase=phase, cmd=cmd, pid=popn.pid)
+        if 'timeout' in opts and self.watchdog != None:
+            self.cmd_timers[popn.pid] = self.watchdog.add(
+                    float(opts['timeout']), lambda: self.expire_cmd(popn, cmd))
+        return popn
+
+    def record_exit(self, popn, phase, **fields):
+        timer = self.cmd_timers.pop(popn.pid, None)
+        if timer != None:
+            self.watchdog.remove(timer)
+        if popn.pid in self.timed_out_pids:
+            self.timed_out_pids.remove(popn.pid)
+            fields['timeout'] = True
+        self.record('exit', phase=phase, pid=popn.pid,
+                returncode=popn.returncode, **fields)
+
+    def call(self, cmd, phase, index, env=None):
+        start_ns = time.monotonic_ns()
+        popn = self.popen(cmd, phase, index, env)
+        self.called = popn
+        rusage = wait4(popn)
+        self.called = None
+        end_ns = time.monotonic_ns()
+        self.record_exit(popn, phase, start_ns=start_ns, end_ns=end_ns,
+                runtime_ns=end_ns - start_ns, rusage=rusage)
+        return popn.returncode
+
+    def snapshot_window(self, boundary):
+        """Snapshot counters at the 'begin' or 'end' of the measurement window.
+        Returns environment variables for the measure commands."""
+        snapshot = {'time_ns': time.monotonic_ns(),
+                'cpu': sampler.read_cpu()}
+        if self.cgroup != None:
+            snapshot['cgroup_stat'] = cgroup.stat(self.cgroup)
+        self.window[boundary] = snapshot
+        self.record('window_%s' % boundary, counters=snapshot)
+        return dict(os.environ, LAZYBOX_WINDOW=boundary)
+
+    def mark_window(self, boundary):
+        """Snapshot counters at the 'begin' or 'end' of the measurement window,
+        and run the measure commands with LAZYBOX_WINDOW set as the boundary"""
+        env = self.snapshot_window(boundary)
+        for index, measure in enumerate(self.measure_cmds):
+            self.call(measure, 'measure', index, env)
+
+    def phase(self, name, begin):
+        self.record('phase_begin' if begin else 'phase_end', phase=name)
+        if begin:
+            self.current_phase = name
+            if name in self.timeouts and self.watchdog != None:
+                self.phase_timer = self.watchdog.add(self.timeouts[name],
+                        lambda: self.expire(name))
+        elif self.phase_timer != None:
+            self.watchdog.remove(self.phase_timer)
+            self.phase_timer = None
+
+    def record_runs(self, runs):
+        """Record the number of runs of main commands.  'runs' is a list of
+        [name, command, number of runs, number of runs that ended by itself]
+        """
+        if not silence:
+            for name, cmd, nr_runs, nr_completed_runs in runs:
+                print(ltime(), "%s ran %d times (%d completed)" % (cmd,
+                    nr_runs, nr_completed_runs))
+        self.record('main_runs', policy=self.main_policy,
+                runs=[{'name': name, 'cmd': cmd, 'runs': nr_runs,
+                    'completed_runs': nr_completed_runs}
+                    for name, cmd, nr_runs, nr_completed_runs in runs])
+
+    def expire_cmd(self, popn, cmd):
+        "Kill the command of which timeout passed"
+        if popn.returncode != None:
+            return
+        if not silence:
+            print(ltime(), "%s (%s) timed out" % (cmd, popn.pid))
+        self.timed_out_pids.add(popn.pid)
+        kill_childs_self(popn.pid)
+
+    def expire(self, name):
+        "Kill the running commands as the timeout of the phase or exp passed"
+        self.timed_out = [name, self.current_phase]
+        if not silence:
+            print(ltime(), "%s timed out during %s phase" % (name,
+                self.current_phase))
+        self.record('timeout', timeout=name, phase=self.current_phase)
+        self.kill_running()
+
+    def kill_running(self):
+        "Send the termination signals to the running commands, without reaping"
+        procs = [t.popn for t in self.main_tasks] + self.back_procs + \
+                self.warmup_procs + [self.called]
+        procs = [p for p in procs if p != None and p.returncode == None]
+        # not the whole cgroup, as daemons of start commands could be needed
+        # by end commands
+        for proc in procs:
+            kill_childs_self(proc.pid)
+
     def terminate_tasks(self):
         if not silence:
             print(ltime(), "terminate tasks of exp %s" % self)
+        self.kill_running()
+
         for task in self.main_tasks:
-            if task.popn.poll() == None:
-                kill_childs_self(task.popn.pid)
+            if task.popn.returncode == None and task.reap():
+                self.record_exit(task.popn, 'main', run=task.nr_runs,
+                        **task.timing())
+        for procs, phase in [[self.back_procs, 'back'],
+                [self.warmup_procs, 'warmup']]:
+            for proc in procs:
+                if proc.returncode == None and reap(proc):
+                    self.record_exit(proc, phase)
 
+    def apply_env(self):
+        "Apply the environment profile and record the effective settings"
+        self.env_previous = None
+        if self.env_profile == None:
+            return
+        previous, effective, mismatches = envprofile.apply(
+                envprofile.load(self.env_profile))
+        self.env_previous = previous
+        for path in mismatches:
+            print(ltime(), "WARNING: %s is %s after applying env profile" % (
+                path, effective[path]))
         if not silence:
-            print(ltime(), "kill background procs")
-        for back_proc in self.back_procs:
-            if back_proc.poll() == None:
-                kill_childs_self(back_proc.pid)
+            print(ltime(), "env: %s" % effective)
+        self.record('env_apply', previous=previous, effective=effective,
+                mismatches=mismatches)
+
+    def restore_env(self):
+        if self.env_previous == None:
+            return
+        envprofile.restore(self.env_previous)
+        self.record('env_restore', restored=self.env_previous)
+        self.env_previous = None
 
     def execute(self):
         "Returns True if experiment executed successfully, False if not"
+        self.cgroup = None
+        self.cgroup_stat = None
+        self.failure = None
+        if use_cgroup:
+            self.cgroup = cgroup.create()
+        self.logspool = None
+        if self.logs_dir != None:
+            self.logspool = logspool.LogSpool(self.logs_dir,
+                    self.log_max_bytes, self.log_rotations)
+            self.logspool.start()
+        self.record('exp_begin', start=self.start_cmds, main=self.main_cmds,
+                back=self.back_cmds, end=self.end_cmds, check=self.check_cmds)
+        self.timed_out = None
+        self.called = None
+        self.cmd_timers = {}
+        self.timed_out_pids = set()
+        self.watchdog = watchdog.Watchdog()
+        self.watchdog.start()
+        if 'exp' in self.timeouts:
+            self.watchdog.add(self.timeouts['exp'], lambda: self.expire('exp'))
+        success = False
+        try:
+            self.apply_env()
+            success = self.execute_cmds()
+            return success
+        finally:
+            self.watchdog.stop()
+            self.watchdog = None
+            if self.logspool != None:
+                self.logspool.stop()
+            self.restore_env()
+            if self.cgroup != None:
+                # processes left after the end commands, e.g., daemons of
+                # start commands
+                cgroup.terminate(self.cgroup, int_grace, term_grace)
+                self.cgroup_stat = cgroup.stat(self.cgroup)
+                if not silence:
+                    print(ltime(), "resource usage: %s" % self.cgroup_stat)
+                cgroup.destroy(self.cgroup)
+            self.record('exp_end', success=success, failure=self.failure,
+                    cgroup_stat=self.cgroup_stat)
+
+    def reset_tasks(self):
         self.back_procs = []
+        self.warmup_procs = []
         self.main_tasks = []
-        if not silence:
-            print(ltime(), "do exp %s" % self)
-        for start in self.start_cmds:
-            subprocess.call(start, shell=True, executable="/bin/bash")
-        for back in self.back_cmds:
-            self.back_procs.append(subprocess.Popen(back, shell=True,
-                executable="/bin/bash"))
 
-        for main in self.main_cmds:
-            self.main_tasks.append(Task(main, subprocess.Popen(main,
-                shell=True, executable="/bin/bash")))
+    def spawn_back(self, cmd, index):
+        self.back_procs.append(self.popen(cmd, 'back', index))
+
+    def run_warmups(self):
+        "Run the warmup commands together, and wait for those"
+        for index, warmup in enumerate(self.warmup_cmds):
+            self.warmup_procs.append(self.popen(warmup, 'warmup', index))
+        for warmup_proc in self.warmup_procs:
+            warmup_proc.wait()
+            self.record_exit(warmup_proc, 'warmup')
+
+    def spawn_main(self, cmd, index):
+        """Start the main command.  Returns the tasks for the command, which
+        have 'cmd', 'name', 'pid', 'start_ns' and 'end_ns'."""
+        task = Task(cmd, index, self.popen(cmd, 'main', index))
+        self.main_tasks.append(task)
+        return [task]
+
+    def respawn_main(self, task):
+        "Start the terminated main task again.  Returns the new task."
+        task.set_popn(self.popen(task.cmd, 'main', task.index))
+        return task
+
+    def wait_main(self, tasks):
+        """Wait until at least one of the main tasks terminates.  Returns the
+        terminated tasks, of which exits are recorded."""
+        terminated = wait_tasks(tasks)
+        for task in terminated:
+            # record_exit() forgets the timed out pid
+            task.timed_out = task.pid in self.timed_out_pids
+            self.record_exit(task.popn, 'main', run=task.nr_runs,
+                    **task.timing())
+        return terminated
+
+    def main_pids(self):
+        return [t.popn.pid for t in self.main_tasks]
+
+    def terminate_workload(self):
+        "Terminate and reap the commands, for the terminate phase"
+        self.terminate_tasks()
+        for task in self.main_tasks:
+            task.close_pidfd()
+
+    def run_workload(self):
+        """Run start, back, warmup and main commands.  Returns early if a
+        timeout passes."""
+        self.phase('start', True)
+        for index, start in enumerate(self.start_cmds):
+            if self.timed_out != None:
+                break
+            self.call(start, 'start', index)
+        self.phase('start', False)
+        if self.timed_out != None:
+            return
+
+        self.phase('back', True)
+        for index, back in enumerate(self.back_cmds):
+            self.spawn_back(back, index)
+        self.phase('back', False)
+
+        if len(self.warmup_cmds) > 0:
+            self.phase('warmup', True)
+            self.run_warmups()
+            self.phase('warmup', False)
+            if self.timed_out != None:
+                return
+        self.mark_window('begin')
+
+        self.phase('main', True)
+        running = []
+        for index, main in enumerate(self.main_cmds):
+            running += self.spawn_main(main, index)
+        smplr = None
+        if self.sample_file != None:
+            smplr = sampler.Sampler(self.main_pids, self.sample_interval,
+                    self.sample_file)
+            smplr.start()
 
         # If more than one main tasks specified, tasks terminated earlier
-        # become infinite background job until slowest main task be terminated.
-        nr_completed = 0
-        while nr_completed < len(self.main_tasks):
-            time.sleep(0.5)
-            for task in self.main_tasks:
-                if task.popn.poll() == None:
-                    continue
+        # become infinite background job until slowest main task be terminated,
+        # for the 'respawn' policy.
+        # [name, command, number of runs, number of completed runs]
+        runs = {t.name: [t.name, t.cmd, 1, 0] for t in running}
+        completed = set()
+        while len(completed) < len(runs) and len(running) > 0:
+            for task in self.wait_main(running):
+                running.remove(task)
                 if not silence:
-                    print(ltime(), "%s (%s) terminated" % (
-                        task.cmd, task.popn.pid))
-                task.completed = True
-                nr_completed = sum(t.completed for t in self.main_tasks)
-                if nr_completed < len(self.main_tasks):
-                    task.popn = subprocess.Popen(task.cmd, shell=True,
-                            executable="/bin/bash")
-        self.terminate_tasks()
+                    print(ltime(), "%s (%s) terminated in %.3f seconds" % (
+                        task.cmd, task.pid,
+                        (task.end_ns - task.start_ns) / 1e9))
+                # no more run is needed after a timeout, but a run killed by
+                # the timeout is not a completed run
+                completed.add(task.name)
+                if task.timed_out:
+                    continue
+                runs[task.name][3] += 1
+                if self.timed_out != None or \
+                        self.main_policy == 'stop-on-first':
+                    # the others are killed by timeout, or terminate phase
+                    completed = set(runs)
+                    continue
+                if (len(completed) < len(runs) and
+                        self.main_policy == 'respawn'):
+                    running.append(self.respawn_main(task))
+                    runs[task.name][2] += 1
+        self.record_runs(list(runs.values()))
+        self.phase('main', False)
+        if smplr != None:
+            smplr.stop()
+        if self.timed_out != None:
+            return
+        self.mark_window('end')
+        if not silence and len(self.warmup_cmds) > 0:
+            print(ltime(), "measurement window: %.3f seconds" % (
+                (self.window['end']['time_ns'] -
+                    self.window['begin']['time_ns']) / 1e9))
+
+    def execute_cmds(self):
+        self.reset_tasks()
+        self.window = {}
+        if not silence:
+            print(ltime(), "do exp %s" % self)
+        self.run_workload()
+
+        self.phase('terminate', True)
+        self.terminate_workload()
+        self.phase('terminate', False)
+
+        # end commands run even after timeouts of the other phases, to clean up
+        self.phase('end', True)
+        for index, end in enumerate(self.end_cmds):
+            if self.timed_out != None and self.timed_out[1] == 'end':
+                break
+            self.call(end, 'end', index)
+        self.phase('end', False)
 
-        for end in self.end_cmds:
-            subprocess.call(end, shell=True, executable="/bin/bash")
+        if self.timed_out != None:
+            self.failure = ['timeout', self.timed_out[0]]
+            return False
 
-        for check in self.check_cmds:
-            ret = subprocess.call(check, shell=True, executable="/bin/bash")
+        self.phase('check', True)
+        success = True
+        for index, check in enumerate(self.check_cmds):
+            ret = self.call(check, 'check', index)
+            if self.timed_out != None:
+                self.failure = ['timeout', self.timed_out[0]]
+                success = False
+                break
             if not silence:
                 print(ltime(), "check %s return %s" % (check, ret))
-            if ret != 0 and not silence:
-                print(ltime(), "check %s failed with return code %s" %
-                        (check, ret))
-                return False
-        return True
+            if ret != 0:
+                if not silence:
+                    print(ltime(), "check %s failed with return code %s" %
+                            (check, ret))
+                self.failure = [check, ret]
+                success = False
+                break
+        self.phase('check', False)
+        return success
 
 verbose = False
 
-def kill_childs_self(pid):
-    childs = all_childs(pid)
-    for child in reversed(childs):
-        if child == pid:
-            continue
+# Seconds to wait for the processes to be terminated by SIGINT and SIGTERM
+int_grace = 0.5
+term_grace = 0.1
+
+def signal_pids(pids, sigs):
+    for pid in pids:
         try:
-            # send INT, TERM and than KILL to give a chance to be terminated
-            # well and than to ensure it terminated because TERM could be
-            # handled by process while KILL couldn't.
-            # Because the processes are stopeed by SIGSTOP that sent from
-            # childs_of(), we should send SIGCONT, too.  It may spawn one more
-            # child while it.  But, let's just hope for now...
-            if verbose:
-                print(ltime(), "kill child: ", child)
-            os.kill(child, signal.SIGINT)
-            os.kill(child, signal.SIGCONT)
-            time.sleep(0.5)
-            os.kill(child, signal.SIGTERM)
-            time.sleep(0.1)
-            os.kill(child, signal.SIGKILL)
+            for sig in sigs:
+                os.kill(pid, sig)
         except OSError as e:
             print(ltime(), "error %s occurred while killing child %s" %
-                    (e, child))
+                    (e, pid))
+
+def kill_childs_self(pid):
+    # send INT, TERM and than KILL to give a chance to be terminated well and
+    # than to ensure it terminated because TERM could be handled by process
+    # while KILL couldn't.  Signals are sent to every child at once, and only
+    # the survivors of each grace period get the next signal.
+    # Because the processes are stopeed by SIGSTOP that sent from childs_of(),
+    # we should send SIGCONT, too.  It may spawn one more child while it.
+    # But, let's just hope for now...
+    childs = [c for c in reversed(all_childs(pid)) if c != pid]
+    pidfds = {c: proctree.pidfd_of(c) for c in childs}
+    try:
+        if verbose:
+            print(ltime(), "kill childs: ", childs)
+        signal_pids(childs, [signal.SIGINT, signal.SIGCONT])
+        survivors = proctree.wait_exit(pidfds, int_grace)
+        signal_pids(survivors, [signal.SIGTERM])
+        survivors = proctree.wait_exit({p: pidfds[p] for p in survivors},
+                term_grace)
+        signal_pids(survivors, [signal.SIGKILL])
+    finally:
+        for fd in pidfds.values():
+            if fd != None:
+                os.close(fd)
     try:
         if verbose:
             print(ltime(), "kill self: %s" % pid)
@@ -181,28 +880,7 @@ def all_childs(pid):
     return childs
 
 def childs_of(pid, stop_childs, print_tree=True):
-    childs = []
-    p = subprocess.Popen('pstree -p %s' % pid, shell=True,
-            stdout=subprocess.PIPE, bufsize=1)
-    for line in p.stdout:
-        line = line.decode('utf-8')
-        if print_tree:
-            print(ltime(), line)
-        spltd = line.split('(')
-        for idx, entry in enumerate(spltd):
-            # skip thread
-            if idx > 0 and spltd[idx-1][-1] == '}':
-                continue
-            if entry.find(')') == -1:
-                continue
-            child_id = entry.split(')')[0]
-            if not child_id.isdigit():
-                continue
-            if stop_childs:
-                try:
-                    os.kill(int(child_id), signal.SIGSTOP)
-                except OSError as e:
-                    print(ltime(), "error %s occurred while stopping child %s"
-                            % (e, child_id))
-            childs.append(int(child_id))
-    return childs
+    "Returns the process and its descendants, parents first"
+    if print_tree:
+        proctree.pr_tree(pid)
+    return proctree.descendants(pid, stop_childs)
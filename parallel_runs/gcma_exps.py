@@ -1,15 +1,24 @@
 #!/usr/bin/env python3
 
-import os
-import sys
-import ssh_args
+import argparse
 
-user, target, port, password = ssh_args.parse_input()
+import kernel_exps
+import remote_cmds
+import sshpool
 
-lbpath = "/home/%s/lazybox" % user
+parser = argparse.ArgumentParser()
+parser.add_argument('user', metavar='<user name>', help='ssh user name')
+parser.add_argument('target', metavar='<target>', help='target host')
+parser.add_argument('port', metavar='<ssh port>', type=int, help='ssh port')
+parser.add_argument('--state', metavar='<file>', default='gcma_exps.state',
+        help='file to keep the progress, for resuming')
+args = parser.parse_args()
+
+conn = sshpool.SshConnection('%s@%s' % (args.user, args.target), args.port)
+lbpath = "/home/%s/lazybox" % args.user
 
 bootloader = "grub"
-if target == "raspberrypi":
+if args.target == "raspberrypi":
     bootloader = "rasp2"
 
 k_cma = "cma"
@@ -17,10 +26,11 @@ k_gcma = "gcma"
 k_vanilla = "vanilla"
 kernels = [k_cma, k_gcma, k_vanilla]
 kparam_cma = "coherent_pool=16M cma=64M smsc95xx.turbo_mode=N"
-expspath = "./exps/"
+expspath = "exps/"
 exps = ["gcma", "gcma-blogbench",
         "still", "still-blogbench", "blogbench-still", "blogbench"]
 
+jobs = []
 for kernel in kernels:
     for exp in exps:
         kernel_param = ""
@@ -28,10 +38,12 @@ for kernel in kernels:
             kernel_param = kparam_cma
         if kernel == k_vanilla and (exp == "gcma" or exp == "gcma-blogbench"):
             continue
-        os.system("expect ./remote_set_kernel.exp %s %s %s %s %s %s %s %s" % (
-            user, target, port, password, lbpath, bootloader, kernel, kernel_param))
+        setup_cmds = []
         if kernel == k_gcma:
-            os.system("expect ./remote_zram_swap.exp %s %s %s %s %s 100M" % (
-                user, target, port, password, lbpath))
-        os.system("expect ./remote_exps.exp %s %s %s %s %s %s" % (
-            user, target, port, password, lbpath, expspath + exp))
+            setup_cmds = remote_cmds.zram_swap_cmds(lbpath, "100M")
+        jobs.append(kernel_exps.Job(kernel, expspath + exp, kernel_param,
+            setup_cmds))
+
+if not kernel_exps.run_matrix(conn, lbpath, bootloader, jobs, args.state):
+    print("stopped.  run again with same --state to resume")
+    exit(1)
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+"""
+Record events of experiments runs in a machine-readable journal
+
+Each event is written as a line of JSON object having 'time_ns' (from
+time.monotonic_ns()) and 'event' fields, plus event-specific fields.
+"""
+
+import json
+import os
+import threading
+import time
+
+journal_file = None
+lock = threading.Lock()
+
+def open_journal(path):
+    global journal_file
+    journal_file = open(path, 'a', buffering=1)
+    record('run_start', pid=os.getpid(), wall_time_ns=time.time_ns())
+
+def close_journal():
+    global journal_file
+    if journal_file == None:
+        return
+    record('run_end')
+    journal_file.close()
+    journal_file = None
+
+def record(event, **fields):
+    "Record an event.  Does nothing if the journal is not opened."
+    if journal_file == None:
+        return
+    fields['time_ns'] = time.monotonic_ns()
+    fields['event'] = event
+    write_event(fields)
+
+def write_event(fields):
+    """Write an event having all fields including 'time_ns' and 'event', e.g.,
+    an event read from another journal.  Does nothing if the journal is not
+    opened."""
+    if journal_file == None:
+        return
+    line = json.dumps(fields, sort_keys=True) + '\n'
+    with lock:
+        journal_file.write(line)
+
+def read_journal(path):
+    "Returns a generator of the events in the journal file, as dicts"
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # the last line could be partially written by a crash
+                continue
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+"""
+Run experiments on a remote host for each of multiple kernels
+
+Experiments of a matrix are grouped by the kernel to boot, so the host reboots
+only once per kernel, rather than once per experiment.  The progress is kept
+in a state file, so that an interrupted run can be resumed without repeating
+the completed experiments, and the reboot for the current kernel.
+"""
+
+__author__ = "SeongJae Park"
+__email__ = "sj38.park@gmail.com"
+__copyright__ = "Copyright (c) 2013-2020, SeongJae Park"
+__license__ = "GPLv2"
+
+import json
+import os
+import shlex
+import subprocess
+import time
+
+import remote_cmds
+
+class Job:
+    """An experiment spec file to run on the host booted with the kernel and
+    the kernel parameters.  The path of the file, and paths in the file, are
+    relative to the lazybox directory of the host.  'setup_cmds' are run
+    with sudo once after the boot, so jobs having different setup commands
+    are not grouped together."""
+    def __init__(self, kernel, exp, kernel_param='', setup_cmds=[]):
+        self.kernel = kernel
+        self.exp = exp
+        self.kernel_param = kernel_param
+        self.setup_cmds = setup_cmds
+
+    def boot_key(self):
+        return json.dumps([self.kernel, self.kernel_param, self.setup_cmds])
+
+    def key(self):
+        return json.dumps([self.kernel, self.kernel_param, self.setup_cmds,
+            self.exp])
+
+def group_jobs(jobs):
+    """Group the jobs by the kernels to boot, in the order of the first job of
+    each group"""
+    groups = {}
+    for job in jobs:
+        groups.setdefault(job.boot_key(), []).append(job)
+    return list(groups.values())
+
+def read_state(path):
+    if not os.path.exists(path):
+        return {'booted': None, 'boot_id': None, 'done': []}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def write_state(path, state):
+    # write and rename, so that a crash doesn't leave a partial file
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=4, sort_keys=True)
+    os.rename(path + '.tmp', path)
+
+def boot_id(conn):
+    "Returns the id of the current boot of the host, or None if not reachable"
+    ret, out = conn.output('cat /proc/sys/kernel/random/boot_id')
+    if ret != 0:
+        return None
+    return out.strip()
+
+def wait_boot(conn, old_boot_id, timeout, interval=2):
+    """Wait until the host is booted again.  Returns the new boot id, or None
+    if the timeout passes."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        # the master connection of the old boot is not usable
+        conn.close()
+        new_boot_id = boot_id(conn)
+        if new_boot_id != None and new_boot_id != old_boot_id:
+            return new_boot_id
+        time.sleep(interval)
+    return None
+
+def boot(conn, lbpath, bootloader, job, boot_timeout):
+    """Reboot the host with the kernel of the job and run the setup commands.
+    Returns the new boot id, or None on failures."""
+    old_boot_id = boot_id(conn)
+    print('[kernel_exps] boot %s %s' % (job.kernel, job.kernel_param))
+    for ret, out in conn.batch(remote_cmds.set_kernel_cmds(lbpath,
+        bootloader, job.kernel, job.kernel_param), sudo=True):
+        if ret != 0:
+            # don't reboot, or the experiments run on the old kernel
+            print('[kernel_exps] setting kernel failed: %s' % out)
+            return None
+    ret, out = conn.batch(remote_cmds.reboot_cmds(), sudo=True)[0]
+    if ret != 0:
+        print('[kernel_exps] reboot failed: %s' % out)
+        return None
+    new_boot_id = wait_boot(conn, old_boot_id, boot_timeout)
+    if new_boot_id == None:
+        print('[kernel_exps] %s is not booted in %s seconds' % (conn,
+            boot_timeout))
+        return None
+    if len(job.setup_cmds) > 0:
+        for cmd, [ret, out] in zip(job.setup_cmds,
+                conn.batch(job.setup_cmds, sudo=True)):
+            if ret != 0:
+                print('[kernel_exps] setup %s failed (%d): %s' % (cmd, ret,
+                    out))
+                return None
+    return new_boot_id
+
+def run_exp(conn, lbpath, job, run_exps_args=''):
+    """Run the experiment using run_exps.py of the host, from the lazybox
+    directory as remote_exps.exp did.  Returns the exit code."""
+    print('[kernel_exps] run %s on %s' % (job.exp, job.kernel))
+    popn = conn.popen('cd %s && sudo -n ./parallel_runs/run_exps.py %s %s' % (
+        shlex.quote(lbpath), run_exps_args, job.exp),
+        stdin=subprocess.DEVNULL)
+    return popn.wait()
+
+def run_matrix(conn, lbpath, bootloader, jobs, state_file, boot_timeout=600,
+        run_exps_args=''):
+    """Run the jobs on the host of the connection, rebooting the host for each
+    group of the jobs.  Jobs recorded as done in the state file are skipped.
+    Returns False if a boot failed or the host is not reachable."""
+    state = read_state(state_file)
+    for group in group_jobs(jobs):
+        todo = [job for job in group if not job.key() in state['done']]
+        if len(todo) == 0:
+            continue
+        # the host could be rebooted after the last run, e.g., by a crash
+        if (state['booted'] != todo[0].boot_key() or
+                boot_id(conn) != state['boot_id']):
+            state['boot_id'] = boot(conn, lbpath, bootloader, todo[0],
+                    boot_timeout)
+            if state['boot_id'] == None:
+                return False
+            state['booted'] = todo[0].boot_key()
+            write_state(state_file, state)
+        for job in todo:
+            ret = run_exp(conn, lbpath, job, run_exps_args)
+            if ret == 255:
+                # the job is not recorded as done, to be run on resume
+                print('[kernel_exps] connection to %s lost' % conn)
+                return False
+            if ret != 0:
+                print('[kernel_exps] %s on %s returned %d' % (job.exp,
+                    job.kernel, ret))
+            state['done'].append(job.key())
+            write_state(state_file, state)
+    return True
@@ -3,11 +3,10 @@
 import argparse
 import os
 import signal
-import subprocess
-import sys
 import time
 
 import exp
+import proctree
 
 parser = argparse.ArgumentParser()
 parser.add_argument('exp_path', metavar='<exp file>', type=str)
@@ -18,26 +17,18 @@ exp_path = args.exp_path
 print("\n\n%s[kill_run_exps] It's time to say good-bye, run_exps %s!\n\n"
         % (exp.ltime(), exp_path))
 
-p = subprocess.Popen("ps -ef | grep run_exps.py",
-        stdout=subprocess.PIPE, shell=True)
-out, err = p.communicate()
-out = out.decode('utf-8')
-
-print(out)
-
 pid = 0
-out = out.split('\n')
-for line in out:
-    spltd = line.split()
-    if len(spltd) < 8:
+for p in proctree.pids():
+    argv = proctree.cmdline_of(p)
+    if argv == None or len(argv) < 3:
         continue
-    if spltd[7] != "python":
+    if not os.path.basename(argv[0]).startswith("python"):
         continue
-    if os.path.split(spltd[8])[1] != "run_exps.py":
+    if os.path.split(argv[1])[1] != "run_exps.py":
         continue
-    if spltd[9] != exp_path:
+    if argv[2] != exp_path:
         continue
-    pid = int(spltd[1])
+    pid = p
     break
 
 if pid == 0:
@@ -45,13 +36,11 @@ if pid == 0:
     exit(1)
 
 while True:
-    childs = exp.childs_of(pid, False)
     try:
         os.kill(pid, signal.SIGTERM)
     except OSError as e:
         print("error %s while sending SIGTERM" % e)
-    childs = exp.childs_of(pid, False)
-    if len(childs) == 0:
+    if not os.path.isdir('/proc/%d' % pid):
         break
     print("childs of process %s still exists. send signal again after 1 sec" %
             pid)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+"""
+Capture outputs of experiment commands into files
+
+Outputs of each command are written by the command itself into the files,
+which are passed as its stdout and stderr.  Hence no copy is done by the
+harness.  An index file ('index.jsonl' under the logs directory) maps each
+command to its log files.
+"""
+
+import json
+import os
+import shutil
+import threading
+
+INDEX = 'index.jsonl'
+
+def rotate(path, nr_rotations):
+    "Rotate 'path' to 'path.1', 'path.1' to 'path.2', and so on"
+    if nr_rotations == 0:
+        return
+    for i in range(nr_rotations - 1, 0, -1):
+        src = '%s.%d' % (path, i)
+        if os.path.exists(src):
+            os.rename(src, '%s.%d' % (path, i + 1))
+    if os.path.exists(path):
+        shutil.copyfile(path, '%s.1' % path)
+
+class LogSpool:
+    """Log files of the commands of an experiment.  If 'max_bytes' is given,
+    files that grown bigger than that are rotated (copied to '<file>.1') up to
+    'nr_rotations' times, and truncated every 'check_interval' seconds."""
+    def __init__(self, logs_dir, max_bytes=None, nr_rotations=0,
+            check_interval=1):
+        self.logs_dir = logs_dir
+        self.max_bytes = max_bytes
+        self.nr_rotations = nr_rotations
+        self.check_interval = check_interval
+        self.paths = []
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.checker = None
+
+    def start(self):
+        os.makedirs(self.logs_dir, exist_ok=True)
+        self.paths = []
+        open(os.path.join(self.logs_dir, INDEX), 'w').close()
+        if self.max_bytes != None:
+            self.stop_event.clear()
+            self.checker = threading.Thread(target=self.check_sizes,
+                    daemon=True)
+            self.checker.start()
+
+    def stop(self):
+        if self.checker != None:
+            self.stop_event.set()
+            self.checker.join()
+            self.checker = None
+        self.enforce_max_bytes()
+
+    def open(self, name, cmd, phase):
+        """Open stdout and stderr log files for the command.  The files of
+        same 'name' are appended if those are already opened in this run, or
+        truncated after rotating the old ones otherwise."""
+        paths = [os.path.join(self.logs_dir, '%s.%s' % (name, suffix))
+                for suffix in ['stdout', 'stderr']]
+        with self.lock:
+            if not paths[0] in self.paths:
+                for path in paths:
+                    rotate(path, self.nr_rotations)
+                    open(path, 'w').close()
+                    self.paths.append(path)
+                with open(os.path.join(self.logs_dir, INDEX), 'a') as f:
+                    f.write(json.dumps({'name': name, 'phase': phase,
+                        'cmd': cmd, 'stdout': paths[0], 'stderr': paths[1]},
+                        sort_keys=True) + '\n')
+        # append mode, so that the writes continue after truncations
+        return [open(path, 'a') for path in paths]
+
+    def enforce_max_bytes(self):
+        if self.max_bytes == None:
+            return
+        with self.lock:
+            paths = list(self.paths)
+        for path in paths:
+            try:
+                if os.path.getsize(path) <= self.max_bytes:
+                    continue
+                rotate(path, self.nr_rotations)
+                os.truncate(path, 0)
+            except OSError:
+                continue
+
+    def check_sizes(self):
+        while not self.stop_event.wait(self.check_interval):
+            self.enforce_max_bytes()
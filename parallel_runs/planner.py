@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+"""
+Estimate time to run experiments from journals of previous runs
+
+Durations of experiments are read from 'exp_begin' and 'exp_end' events of the
+journals, and matched to the experiments to run by their hashes.  Wall time of
+running the experiments concurrently is estimated by simulating the
+scheduling of run_exps.py.
+"""
+
+import heapq
+import itertools
+
+import exp
+import journal
+
+def read_durations(paths):
+    """Read durations of experiments from the journals.  Returns a dict of
+    experiment hash to the list of the durations in seconds."""
+    durations = {}
+    for path in paths:
+        # times of exp_begin events of ongoing experiments, keyed by the hash
+        begins = {}
+        for event in journal.read_journal(path):
+            if event['event'] == 'run_start':
+                # monotonic time of different runs are not comparable
+                begins = {}
+            elif event['event'] == 'exp_begin':
+                begins.setdefault(event['exp'], []).append(event['time_ns'])
+            elif event['event'] == 'exp_end':
+                if len(begins.get(event['exp'], [])) == 0:
+                    continue
+                begin = begins[event['exp']].pop(0)
+                durations.setdefault(event['exp'], []).append(
+                        (event['time_ns'] - begin) / 1e9)
+    return durations
+
+def estimate(e, durations):
+    "Returns estimated seconds to run the experiment, or None if unknown"
+    history = durations.get(e.digest())
+    if history == None:
+        return None
+    return sum(history) / len(history)
+
+def simulate(estimates, nr_jobs):
+    """Returns estimated wall time to run the experiments as run_exps.py does
+    with 'nr_jobs' jobs.  'estimates' is a list of [exp, seconds]."""
+    estimates = iter(estimates)
+    now = 0
+    pending = []
+    # [end time, index, exp] of the running experiments
+    running = []
+    index = 0
+    while True:
+        pending += itertools.islice(estimates, nr_jobs * 2 - len(pending))
+        if len(pending) == 0 and len(running) == 0:
+            return now
+        for item in list(pending):
+            if len(running) >= nr_jobs:
+                break
+            e, seconds = item
+            if True in [e.conflicts(r[2]) for r in running]:
+                continue
+            pending.remove(item)
+            heapq.heappush(running, [now + seconds, index, e])
+            index += 1
+        now = heapq.heappop(running)[0]
+
+def pr_plan(exps, durations, nr_jobs, nr_expensive=5):
+    "Print estimated time to run the experiments"
+    estimates = [[e, estimate(e, durations)] for e in exps]
+    known = [s for e, s in estimates if s != None]
+    print('[run_exps] plan: %d experiments, %d having no history' % (
+        len(estimates), len(estimates) - len(known)))
+    if len(known) == 0:
+        print('[run_exps] no history to estimate the time')
+        return
+    # assume experiments having no history take the average time
+    average = sum(known) / len(known)
+    for item in estimates:
+        if item[1] == None:
+            item[1] = average
+    total = sum([s for e, s in estimates])
+    print('[run_exps] estimated time: %.1f seconds in total, %.1f seconds '
+            'with %d jobs' % (total, simulate(estimates, nr_jobs), nr_jobs))
+    print('[run_exps] most expensive experiments:')
+    for e, seconds in heapq.nlargest(nr_expensive, estimates,
+            key=lambda x: x[1]):
+        print('%.1f seconds (%s)\n%s' % (seconds, e.digest(),
+            exp.pretty(e.main_cmds)))
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+"Snapshot process trees by reading /proc, without forking pstree or ps"
+
+import os
+import select
+import signal
+import time
+
+def read_children(pid):
+    """Returns child pids of the process read from
+    /proc/<pid>/task/*/children, or None if the file is not supported"""
+    taskdir = '/proc/%d/task' % pid
+    try:
+        tids = os.listdir(taskdir)
+    except OSError:
+        return []
+    childs = []
+    for tid in tids:
+        try:
+            with open(os.path.join(taskdir, tid, 'children'), 'r') as f:
+                childs += [int(c) for c in f.read().split()]
+        except FileNotFoundError:
+            if not os.path.isdir(os.path.join(taskdir, tid)):
+                continue
+            # the kernel is built without CONFIG_PROC_CHILDREN
+            return None
+        except OSError:
+            continue
+    return childs
+
+def read_stat(pid):
+    "Returns fields of /proc/<pid>/stat after the comm field, or None"
+    try:
+        with open('/proc/%d/stat' % pid, 'r') as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # comm can contain spaces and parentheses
+    return stat[stat.rfind(')') + 2:].split()
+
+def pids():
+    return [int(p) for p in os.listdir('/proc') if p.isdigit()]
+
+def children_map():
+    "Returns a map from pid to its child pids, built by scanning /proc/*/stat"
+    childs = {}
+    for pid in pids():
+        fields = read_stat(pid)
+        if fields == None:
+            continue
+        ppid = int(fields[1])
+        if not ppid in childs:
+            childs[ppid] = []
+        childs[ppid].append(pid)
+    return childs
+
+def comm_of(pid):
+    try:
+        with open('/proc/%d/comm' % pid, 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return '?'
+
+def cmdline_of(pid):
+    "Returns argv of the process, or None if it is gone or a kernel thread"
+    try:
+        with open('/proc/%d/cmdline' % pid, 'rb') as f:
+            cmdline = f.read()
+    except OSError:
+        return None
+    if len(cmdline) == 0:
+        return None
+    return [a.decode('utf-8', 'replace') for a in cmdline.split(b'\0')[:-1]]
+
+def descendants(pid, stop=False):
+    """Returns the process and its descendants, parents first.  If 'stop' is
+    True, each process is stopped with SIGSTOP before its children are read, so
+    that it cannot spawn more children while the snapshot is being made."""
+    tree = [pid]
+    seen = set(tree)
+    childs_map = None
+    idx = 0
+    while idx < len(tree):
+        p = tree[idx]
+        idx += 1
+        if stop:
+            try:
+                os.kill(p, signal.SIGSTOP)
+            except OSError:
+                pass
+        childs = None
+        if childs_map == None:
+            childs = read_children(p)
+        if childs == None:
+            if childs_map == None:
+                childs_map = children_map()
+            childs = childs_map.get(p, [])
+        for child in childs:
+            if not child in seen:
+                seen.add(child)
+                tree.append(child)
+    return tree
+
+def pr_tree(pid, indent=0, childs_map=None):
+    if childs_map == None:
+        childs_map = children_map()
+    print('%s%s(%d)' % (' ' * indent, comm_of(pid), pid))
+    for child in childs_map.get(pid, []):
+        pr_tree(child, indent + 2, childs_map)
+
+def pidfd_of(pid):
+    "Returns a pidfd for the process, or None if pidfd is not supported"
+    if not hasattr(os, 'pidfd_open'):
+        return None
+    try:
+        return os.pidfd_open(pid)
+    except OSError:
+        return None
+
+def alive(pid):
+    "Returns True if the process exists and is not a zombie"
+    fields = read_stat(pid)
+    return fields != None and fields[0] != 'Z'
+
+def wait_exit(pidfds, timeout):
+    """Wait until all the processes exit or the timeout (seconds) passes.
+    'pidfds' is a dict of pids to their pidfds, or None if pidfd is not
+    supported.  Returns pids of the processes that are still alive."""
+    deadline = time.monotonic() + timeout
+    while True:
+        poller = select.poll()
+        survivors = []
+        for pid, fd in pidfds.items():
+            if fd == None:
+                if alive(pid):
+                    survivors.append(pid)
+                continue
+            poller.register(fd, select.POLLIN)
+        exited = set([fd for fd, event in poller.poll(0)])
+        survivors += [pid for pid, fd in pidfds.items()
+                if fd != None and not fd in exited]
+        remaining = deadline - time.monotonic()
+        if len(survivors) == 0 or remaining <= 0:
+            return survivors
+        if None in [pidfds[pid] for pid in survivors]:
+            time.sleep(min(remaining, 0.01))
+        else:
+            poller.poll(remaining * 1000)
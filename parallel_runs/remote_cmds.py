@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+"""
+Run commands on multiple remote hosts in parallel
+
+The commands are sent to each host as a batch over a persistent ssh
+connection, and the output and the exit code of each command on each host are
+printed.  This replaces the expect scripts (remote_cmds.exp, remote_stat.exp,
+remote_reboot.exp, remote_zram_swap.exp and remote_set_kernel.exp) and
+ssh_parallel.sh of parallel_ssh_cmds, using public key authentication instead
+of passwords.
+"""
+
+__author__ = "SeongJae Park"
+__email__ = "sj38.park@gmail.com"
+__copyright__ = "Copyright (c) 2013-2020, SeongJae Park"
+__license__ = "GPLv2"
+
+import argparse
+import shlex
+import sys
+import time
+
+import sshpool
+
+def set_kernel_cmds(lbpath, bootloader, kernel, kernel_param=''):
+    """Commands for setting the kernel to boot on the next boot, to be
+    sudo-ed.  Run reboot_cmds() after those succeeded."""
+    return ['cd %s && ./linux_hack/set_kernel.py --bootloader %s %s %s'
+            % (shlex.quote(lbpath), shlex.quote(bootloader),
+                shlex.quote(kernel),
+                ' '.join([shlex.quote(p) for p in kernel_param.split()]))]
+
+def zram_swap_cmds(lbpath, size):
+    return ['cd %s && ./scripts/zram_swap.sh %s' % (shlex.quote(lbpath),
+        shlex.quote(size))]
+
+def reboot_cmds():
+    # in background, so that the batch returns before the connection is lost
+    return ['sync && (nohup shutdown -r now > /dev/null 2>&1 &)']
+
+def wait_hosts(pool, hosts, timeout, interval=2):
+    """Wait until the hosts accept ssh connections.  Returns the hosts that
+    are not reachable until the timeout."""
+    deadline = time.time() + timeout
+    waiting = list(hosts)
+    while True:
+        for host in waiting:
+            # connections before reboots are not usable
+            pool.get(host).close()
+        results = pool.batch(waiting, ['true'])
+        waiting = [h for h in waiting if results[h][0][0] != 0]
+        if len(waiting) == 0 or time.time() + interval > deadline:
+            return waiting
+        time.sleep(interval)
+
+def pr_results(results, cmds, quiet):
+    "Print the results of batches.  Returns the number of failed commands."
+    nr_failed = 0
+    for host in sorted(results):
+        for cmd, [ret, out] in zip(cmds, results[host]):
+            if ret != 0:
+                nr_failed += 1
+            if quiet and ret == 0:
+                continue
+            print('[%s] $ %s' % (host, cmd))
+            for line in out.split('\n'):
+                if line != '':
+                    print('[%s] %s' % (host, line))
+            print('[%s] exit code %d' % (host, ret))
+    return nr_failed
+
+def read_hosts(path):
+    "Read the destinations of the hosts inventory file of remote_run_exps.py"
+    hosts = []
+    with open(path, 'r') as f:
+        for line in f:
+            fields = line.split('#')[0].split()
+            if len(fields) > 0:
+                hosts.append(fields[0])
+    return hosts
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('cmds', metavar='<cmd>', nargs='+',
+            help='command to run')
+    parser.add_argument('--hosts', metavar='<[user@]host[:port]>', nargs='+',
+            default=[], help='hosts to run the commands')
+    parser.add_argument('--inventory', metavar='<file>',
+            help='hosts inventory file of remote_run_exps.py')
+    parser.add_argument('--sudo', action='store_true',
+            help='run the commands with \'sudo -n\'')
+    parser.add_argument('--quiet', '-q', action='store_true',
+            help='print outputs of failed commands only')
+    parser.add_argument('--ssh', metavar='<cmd>', default=sshpool.ssh_cmd,
+            help='ssh command to use')
+    args = parser.parse_args()
+
+    sshpool.ssh_cmd = args.ssh
+    hosts = args.hosts
+    if args.inventory != None:
+        hosts += read_hosts(args.inventory)
+    if len(hosts) == 0:
+        print('no host is given')
+        exit(1)
+
+    pool = sshpool.SshPool()
+    results = pool.batch(hosts, args.cmds, args.sudo)
+    pool.close()
+    sshpool.cleanup()
+    nr_failed = pr_results(results, args.cmds, args.quiet)
+    if nr_failed > 0:
+        print('%d of %d commands failed' % (nr_failed,
+            len(hosts) * len(args.cmds)))
+        sys.exit(1)
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+
+"""
+Run experiments of spec files on multiple remote hosts
+
+Each host runs one experiment at a time using its 'run_exps.py', and gets the
+next one when it finishes, so faster hosts run more experiments.  Commands to
+each host are sent over a persistent ssh connection.  Outputs of the remote
+'run_exps.py' are streamed with the name of the host as the prefix, and the
+journal of each experiment is copied back to the local journal.  Result
+directories of each host are copied back after its last experiment.
+"""
+
+__author__ = "SeongJae Park"
+__email__ = "sj38.park@gmail.com"
+__copyright__ = "Copyright (c) 2013-2020, SeongJae Park"
+__license__ = "GPLv2"
+
+import argparse
+import json
+import os
+import shlex
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import journal
+import run_exps
+import sshpool
+
+DEFAULT_LBPATH = 'lazybox'
+
+def read_inventory(path):
+    """Read the hosts inventory file.  Each line is
+    '<[user@]host[:port]> [<lazybox path>]'.  Returns a list of Hosts."""
+    hosts = []
+    with open(path, 'r') as f:
+        for line in f:
+            fields = line.split('#')[0].split()
+            if len(fields) == 0:
+                continue
+            destination, port = sshpool.parse_destination(fields[0])
+            lbpath = fields[1] if len(fields) > 1 else DEFAULT_LBPATH
+            hosts.append(Host(sshpool.SshConnection(destination, port),
+                lbpath))
+    return hosts
+
+def iter_exp_texts(exp_files):
+    "Yield spec text of each experiment in the files, expanding the sweeps"
+    for exp_file in exp_files:
+        with open(exp_file, 'r') as f:
+            for lines in run_exps.iter_exp_lines(f):
+                for expanded in run_exps.expand_sweep(lines):
+                    yield '\n'.join(expanded) + '\n'
+
+# run_exps.py options for the remote run_exps.py
+run_exps_args = ''
+sudo = False
+silence = False
+# directories to copy back from each host after its experiments, and the local
+# directory to copy those into
+fetch_dirs = []
+fetch_to = 'remote_results'
+
+stop_event = threading.Event()
+print_lock = threading.Lock()
+# for the experiments and the below variables
+exps_cond = threading.Condition()
+exps = iter([])
+# experiments to be run again by other hosts, as [index, text]
+requeued = []
+# [host, index, text, exit code]
+failures = []
+nr_exps = 0
+# number of hosts running an experiment
+nr_busy_hosts = 0
+
+def next_exp():
+    """Returns [index, spec text] of the next experiment to run, or None.  If
+    no experiment is left but some hosts are running experiments, waits for
+    those, as their experiments could be requeued if the hosts are broken."""
+    global nr_exps
+    global nr_busy_hosts
+    with exps_cond:
+        while not stop_event.is_set():
+            if len(requeued) > 0:
+                nr_busy_hosts += 1
+                return requeued.pop(0)
+            text = next(exps, None)
+            if text != None:
+                nr_exps += 1
+                nr_busy_hosts += 1
+                return [nr_exps - 1, text]
+            if nr_busy_hosts == 0:
+                break
+            exps_cond.wait()
+        return None
+
+def exp_done(exp, requeue):
+    global nr_busy_hosts
+    with exps_cond:
+        nr_busy_hosts -= 1
+        if requeue:
+            requeued.append(exp)
+        exps_cond.notify_all()
+
+def pr_line(host, line):
+    with print_lock:
+        print('[%s] %s' % (host, line))
+        sys.stdout.flush()
+
+class Host(threading.Thread):
+    """A remote host running experiments one by one.  'lbpath' is the path to
+    lazybox on the host."""
+    def __init__(self, conn, lbpath):
+        threading.Thread.__init__(self, daemon=True)
+        self.conn = conn
+        self.lbpath = lbpath
+        self.prefix = 'lazybox-remote-%s-%d' % (os.uname().nodename,
+                os.getpid())
+        self.popn = None
+        self.nr_exps = 0
+        self.nr_failed = 0
+        self.busy_secs = 0
+        self.broken = False
+        self.fetch_failed = False
+
+    def remote_cmd(self, index):
+        """Returns a command that runs the experiment spec from stdin, keeping
+        the journal at a temporary file"""
+        exps_file = '/tmp/%s-%d.exps' % (self.prefix, index)
+        journal_file = '/tmp/%s-%d.journal' % (self.prefix, index)
+        run_exps_cmd = './run_exps.py --journal %s %s %s' % (journal_file,
+                run_exps_args, exps_file)
+        if sudo:
+            run_exps_cmd = 'sudo -n ' + run_exps_cmd
+        return ('cat > %s && cd %s && %s; rc=$?; rm -f %s; exit $rc' % (
+            exps_file, shlex.quote(os.path.join(self.lbpath, 'parallel_runs')),
+            run_exps_cmd, exps_file), journal_file)
+
+    def fetch_journal(self, journal_file, index):
+        """Copy the events of the remote journal to the local journal.
+        Returns whether the experiment succeeded, or None if unknown."""
+        ret, out = self.conn.output('cat %s; rm -f %s' % (journal_file,
+            journal_file))
+        success = None
+        for line in out.split('\n'):
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            event['host'] = str(self.conn)
+            event['remote_exp_index'] = index
+            journal.write_event(event)
+            if event['event'] == 'exp_end':
+                success = event.get('success')
+        return success
+
+    def fetch_results(self):
+        """Copy the fetch_dirs of the host into '<fetch_to>/<host>/'.  Returns
+        whether all are copied."""
+        local_root = os.path.join(fetch_to, str(self.conn))
+        success = True
+        for remote_dir in fetch_dirs:
+            local_dir = os.path.join(local_root,
+                    os.path.basename(os.path.normpath(remote_dir)))
+            os.makedirs(local_dir, exist_ok=True)
+            # relative directories are from the parallel_runs directory
+            popn = self.conn.popen('cd %s && tar -cf - -C %s .' % (
+                shlex.quote(os.path.join(self.lbpath, 'parallel_runs')),
+                shlex.quote(remote_dir)), stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE)
+            ret = subprocess.call(['tar', '-xf', '-', '-C', local_dir],
+                    stdin=popn.stdout)
+            popn.stdout.close()
+            if popn.wait() != 0 or ret != 0:
+                pr_line(self.conn, 'fetching %s failed' % remote_dir)
+                success = False
+        return success
+
+    def run_exp(self, index, text):
+        """Run the experiment on the host.  Returns False if the host is not
+        reachable."""
+        cmd, journal_file = self.remote_cmd(index)
+        start = time.time()
+        self.popn = self.conn.popen(cmd, stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT)
+        try:
+            self.popn.stdin.write(text.encode())
+            self.popn.stdin.close()
+        except BrokenPipeError:
+            pass
+        for line in self.popn.stdout:
+            if not silence:
+                pr_line(self.conn, line.decode(errors='replace').rstrip('\n'))
+        ret = self.popn.wait()
+        self.busy_secs += time.time() - start
+        if ret == 255:
+            # ssh failure
+            return False
+        success = self.fetch_journal(journal_file, index)
+        self.nr_exps += 1
+        if success == False or (success == None and ret != 0):
+            self.nr_failed += 1
+            with exps_cond:
+                failures.append([self.conn, index, text, ret])
+        return True
+
+    def run(self):
+        while True:
+            exp = next_exp()
+            if exp == None:
+                break
+            reachable = self.run_exp(*exp)
+            exp_done(exp, not reachable)
+            if not reachable:
+                pr_line(self.conn, 'not reachable; stop using the host')
+                self.broken = True
+                break
+        if not self.broken and self.nr_exps > 0 and len(fetch_dirs) > 0:
+            self.fetch_failed = not self.fetch_results()
+        self.conn.close()
+
+    def terminate(self):
+        "Terminate the remote run_exps.py by closing the connection"
+        if self.popn != None and self.popn.poll() == None:
+            self.popn.terminate()
+
+def pr_summary(hosts, nr_undispatched):
+    """Print the results of the hosts.  'nr_undispatched' is the number of the
+    experiments that no host got, because of a signal or no reachable host.
+    Those and the requeued experiments are counted as failed."""
+    nr_not_run = len(requeued) + nr_undispatched
+    print('[remote_run_exps] %d experiments, %d failed' % (
+        nr_exps + nr_undispatched, len(failures) + nr_not_run))
+    for host in hosts:
+        print('%s: %d experiments (%d failed) in %.3f seconds%s%s' % (
+            host.conn, host.nr_exps, host.nr_failed, host.busy_secs,
+            ' (not reachable)' if host.broken else '',
+            ' (fetching results failed)' if host.fetch_failed else ''))
+    for host, index, text, ret in failures:
+        print('experiment %d failed on %s (exit code %s)\n%s' % (index, host,
+            ret, text.rstrip('\n')))
+    if nr_not_run > 0:
+        print('%d experiments not run' % nr_not_run)
+
+hosts = []
+
+def sig_handler(signal, frame):
+    print('[remote_run_exps] received signal %s' % signal)
+    stop_event.set()
+    with exps_cond:
+        exps_cond.notify_all()
+    for host in hosts:
+        host.terminate()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('inventory', metavar='<file>',
+            help='hosts inventory file')
+    parser.add_argument('exp_files', metavar='<file>', nargs='+',
+            help='experiment spec file')
+    parser.add_argument('--silence', '-s', action='store_true',
+            help='do not print outputs of the remote hosts')
+    parser.add_argument('--sudo', action='store_true',
+            help='run run_exps.py with \'sudo -n\'')
+    parser.add_argument('--run_exps_args', metavar='<args>', default='',
+            help='options for remote run_exps.py')
+    parser.add_argument('--journal', metavar='<file>',
+            help='file to record events of the remote runs')
+    parser.add_argument('--ssh', metavar='<cmd>', default=sshpool.ssh_cmd,
+            help='ssh command to use')
+    parser.add_argument('--fetch', metavar='<dir>', action='append',
+            default=[], help='result directory to copy back from the hosts')
+    parser.add_argument('--fetch_to', metavar='<dir>', default=fetch_to,
+            help='local directory to copy the result directories into')
+    args = parser.parse_args()
+
+    silence = args.silence
+    sudo = args.sudo
+    run_exps_args = args.run_exps_args
+    sshpool.ssh_cmd = args.ssh
+    fetch_dirs = args.fetch
+    fetch_to = args.fetch_to
+    if args.journal != None:
+        journal.open_journal(args.journal)
+
+    signal.signal(signal.SIGINT, sig_handler)
+    signal.signal(signal.SIGTERM, sig_handler)
+
+    exps = iter_exp_texts(args.exp_files)
+    hosts = read_inventory(args.inventory)
+    try:
+        for host in hosts:
+            host.start()
+        for host in hosts:
+            # join() with timeout, so that signals are handled
+            while host.is_alive():
+                host.join(1)
+    finally:
+        sshpool.cleanup()
+    journal.close_journal()
+    nr_undispatched = len(list(exps))
+    pr_summary(hosts, nr_undispatched)
+    if (len(failures) > 0 or len(requeued) > 0 or nr_undispatched > 0 or
+            True in [h.fetch_failed for h in hosts]):
+        exit(1)
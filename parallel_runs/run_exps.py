@@ -8,86 +8,374 @@ __copyright__ = "Copyright (c) 2013-2020, SeongJae Park"
 __license__ = "GPLv2"
 
 import argparse
+import itertools
 import os
 import signal
 import sys
-import time
+import threading
 
+import aexp
 import exp
+import journal
+import planner
 
-def parse_lines(f):
-    START = "start "
-    MAIN = "main "
-    BACK = "back "
-    END = "end "
-    CHECK = "check "
-
-    exps = []
-    starts = []
-    mains = []
-    backs = []
-    ends = []
-    checks = []
-
-    prevline = ''
+def parse_cmd_opts(opts):
+    """Parse options of a command, e.g., 'cpus=0-3:mems=0:sched=fifo/10', into
+    a dict"""
+    ret = {}
+    for opt in opts.split(':'):
+        key, val = opt.split('=', 1)
+        if not key in ['cpus', 'mems', 'sched', 'nr', 'timeout', 'shell']:
+            raise ValueError('unknown command option %s' % key)
+        if key == 'sched':
+            # find wrong policies now, rather than before exec of the command
+            exp.parse_sched(val)
+        ret[key] = val
+    return ret
+
+def cmd_type_of(line):
+    "Returns type and options (None if not given) of the command line"
+    cmd_type = line.split(' ', 1)[0]
+    if not ':' in cmd_type:
+        return cmd_type, None
+    return cmd_type.split(':', 1)
+
+def parse_exp(lines):
+    "Make an exp.Exp from the lines of an experiment"
+    CPUS = "cpus "
+    MEMS = "mems "
+    SLOT = "slot "
+    SAMPLE = "sample "
+    RETRY = "retry "
+    LOGS = "logs "
+    ENV = "env "
+    ENGINE = "engine "
+    TIMEOUT = "timeout "
+    MAIN_POLICY = "main_policy "
+
+    cmds = {'start': [], 'main': [], 'back': [], 'end': [], 'check': [],
+            'warmup': [], 'measure': []}
+    # options of commands, keyed by the type and the index of the command
+    cmd_opts = {}
+    # annotations of the experiment, passed to exp.Exp() as keyword arguments
+    attrs = {}
+    engine = 'thread'
+
+    for line in lines:
+        cmd_type, opts = cmd_type_of(line)
+        if cmd_type in cmds and ' ' in line:
+            cmd = line[line.index(' ') + 1:]
+            cmds[cmd_type].append(cmd)
+            if opts != None:
+                cmd_opts[(cmd_type, len(cmds[cmd_type]) - 1)] = parse_cmd_opts(
+                        opts)
+        elif line.startswith(CPUS):
+            attrs['cpus'] = line[len(CPUS):].strip()
+        elif line.startswith(MEMS):
+            attrs['mems'] = line[len(MEMS):].strip()
+        elif line.startswith(SLOT):
+            attrs['slot'] = line[len(SLOT):].strip()
+        elif line.startswith(SAMPLE):
+            interval, sample_file = line[len(SAMPLE):].split(None, 1)
+            attrs['sample_interval'] = float(interval)
+            attrs['sample_file'] = sample_file.strip()
+        elif line.startswith(RETRY):
+            fields = line[len(RETRY):].split()
+            attrs['retry_limit'] = int(fields[0])
+            if len(fields) > 1:
+                attrs['retry_backoff'] = float(fields[1])
+            if len(fields) > 2:
+                attrs['retry_codes'] = [int(x) for x in fields[2:]]
+        elif line.startswith(LOGS):
+            fields = line[len(LOGS):].split()
+            attrs['logs_dir'] = fields[0]
+            if len(fields) > 1:
+                attrs['log_max_bytes'] = int(fields[1])
+            if len(fields) > 2:
+                attrs['log_rotations'] = int(fields[2])
+        elif line.startswith(ENV):
+            attrs['env_profile'] = line[len(ENV):].strip()
+        elif line.startswith(ENGINE):
+            engine = line[len(ENGINE):].strip()
+            if not engine in ['thread', 'async']:
+                raise ValueError('unknown engine %s' % engine)
+        elif line.startswith(TIMEOUT):
+            name, seconds = line[len(TIMEOUT):].split()
+            if not name in ['start', 'warmup', 'main', 'end', 'check', 'exp']:
+                raise ValueError('unknown timeout target %s' % name)
+            attrs.setdefault('timeouts', {})[name] = float(seconds)
+        elif line.startswith(MAIN_POLICY):
+            policy = line[len(MAIN_POLICY):].strip()
+            if not policy in ['respawn', 'wait-all', 'stop-on-first']:
+                raise ValueError('unknown main policy %s' % policy)
+            attrs['main_policy'] = policy
+
+    if engine == 'async':
+        return aexp.AsyncExp(cmds['start'], cmds['main'], cmds['back'],
+                cmds['end'], cmds['check'], warmup=cmds['warmup'],
+                measure=cmds['measure'], cmd_opts=cmd_opts, **attrs)
+    for opts in cmd_opts.values():
+        for key in ['nr']:
+            if key in opts:
+                raise ValueError('%s option needs engine async' % key)
+    return exp.Exp(cmds['start'], cmds['main'], cmds['back'], cmds['end'],
+            cmds['check'], warmup=cmds['warmup'], measure=cmds['measure'],
+            cmd_opts=cmd_opts, **attrs)
+
+def iter_exp_lines(f):
+    """Yield lines of each experiment in the file.  Comments are removed and
+    the continued lines are joined."""
+    lines = []
+    has_main = False
+    continued = []
     for line in f:
         if line.startswith('#'):
             continue
         line = line.strip('\n').lstrip()
         if line.endswith('\\'):
-            prevline += line[:-1]
+            continued.append(line[:-1])
             continue
+        if len(continued) > 0:
+            continued.append(line)
+            line = ''.join(continued)
+            continued = []
 
-        line = prevline + line
-        prevline = ''
-        if line.startswith(START):
-            starts.append(line[len(START):])
-        elif line.startswith(MAIN):
-            mains.append(line[len(MAIN):])
-        elif line.startswith(BACK):
-            backs.append(line[len(BACK):])
-        elif line.startswith(END):
-            ends.append(line[len(END):])
-        elif line.startswith(CHECK):
-            checks.append(line[len(CHECK):])
-        elif len(line.split()) == 0 and len(mains) > 0:
-            exps.append(exp.Exp(starts, mains, backs, ends, checks))
-            starts = []
-            mains = []
-            backs = []
-            ends = []
-            checks = []
-    if len(mains) != 0:
-        exps.append(exp.Exp(starts, mains, backs, ends, checks))
-    return exps
+        if len(line.split()) == 0:
+            if has_main:
+                yield lines
+                lines = []
+                has_main = False
+            continue
+        lines.append(line)
+        if cmd_type_of(line)[0] == 'main':
+            has_main = True
+    if has_main:
+        yield lines
+
+def expand_sweep(lines):
+    """Yield lines of experiments that made by substituting '@{<name>}' in the
+    lines with each combination of values of 'var <name> <value>...' lines.
+    Values of the last 'var' line change most frequently."""
+    VAR = "var "
+    names = []
+    values = []
+    others = []
+    for line in lines:
+        if line.startswith(VAR):
+            fields = line[len(VAR):].split()
+            if len(fields) < 2:
+                raise ValueError('no value for var line %s' % line)
+            names.append('@{%s}' % fields[0])
+            values.append(fields[1:])
+        else:
+            others.append(line)
+    if len(names) == 0:
+        yield others
+        return
+    for combination in itertools.product(*values):
+        expanded = []
+        for line in others:
+            for name, value in zip(names, combination):
+                line = line.replace(name, value)
+            expanded.append(line)
+        yield expanded
+
+def chain_exps(groups):
+    "Yield the parsed experiments of the groups, parsing the sweeps lazily"
+    for first, expansions in groups:
+        yield first
+        for expanded in expansions:
+            yield parse_exp(expanded)
+
+def iter_exps(f):
+    """Parse the experiments in the file, and returns an iterator of those.
+    Experiments other than the sweeps and the first experiment of each sweep
+    are parsed before the return, so that errors in the file are found before
+    any experiment runs.  The other experiments of the sweeps are expanded and
+    parsed lazily."""
+    groups = []
+    for lines in iter_exp_lines(f):
+        expansions = expand_sweep(lines)
+        groups.append([parse_exp(next(expansions)), expansions])
+    return chain_exps(groups)
+
+def parse_lines(f):
+    return list(iter_exps(f))
 
 def parse_file(filename):
+    "Parse the experiments in the file, as iter_exps() does"
     f = sys.stdin
     if filename != 'stdin':
         f = open(filename)
 
-    exps = parse_lines(f)
+    exps = iter_exps(f)
 
     if filename != 'stdin':
         f.close()
-
     return exps
 
 got_sigterm = False
+stop_event = threading.Event()
 current_exps = []
 
+# Default retry policy for experiments not specifying their own
+RETRY_LIMIT = 10
+retry_backoff = 0
+
+# List of [failed experiment, number of attempts, last failure]
+failures = []
+
+# File recording successfully completed experiments, and keys of those
+progress_file = None
+progress_lock = threading.Lock()
+progress_keys = {}
+
+def set_progress_keys(exps, exp_file):
+    """Set progress keys of the experiments while yielding those.  The key is
+    made with the spec file name, the hash of the experiment, and the number
+    of previous experiments having same hash in the file."""
+    counts = {}
+    for e in exps:
+        digest = e.digest()
+        counts[digest] = counts.get(digest, 0) + 1
+        progress_keys[e] = '%s %s %d' % (exp_file, digest, counts[digest])
+        yield e
+
+def skip_completed(exps, completed):
+    for e in exps:
+        if progress_keys[e] in completed:
+            del progress_keys[e]
+            if not exp.silence:
+                print('[run_exps] skip completed experiment %s' %
+                        exp.pretty(e.main_cmds))
+            continue
+        yield e
+
+def read_progress(path):
+    "Returns keys of the experiments that recorded as completed in the file"
+    if not os.path.isfile(path):
+        return set()
+    with open(path, 'r') as f:
+        return set([l.strip() for l in f if l.strip() != ''])
+
+def record_progress(exp):
+    if progress_file == None:
+        return
+    with progress_lock:
+        progress_file.write(progress_keys[exp] + '\n')
+        progress_file.flush()
+        # the host could be rebooted by the experiment commands
+        os.fsync(progress_file.fileno())
+
+def run_exp(e):
+    """Execute the experiment, retrying on failures as its retry policy
+    specifies.  Returns True if the experiment succeeded."""
+    limit = e.retry_limit if e.retry_limit != None else RETRY_LIMIT
+    backoff = e.retry_backoff if e.retry_backoff != None else retry_backoff
+    nr_attempts = 0
+    current_exps.append(e)
+    try:
+        while nr_attempts < limit:
+            if got_sigterm:
+                return False
+            nr_attempts += 1
+            try:
+                succeeded = e.execute()
+            except Exception as exc:
+                # e.g., unwritable log files.  Don't kill the thread
+                # of run_exps_concurrently() silently.
+                print('[run_exps] exception from an experiment: %r' % exc)
+                failures.append([e, nr_attempts, ['exception', repr(exc)]])
+                return False
+            if succeeded:
+                record_progress(e)
+                return True
+            if not e.retryable():
+                break
+            if nr_attempts == limit:
+                break
+            if not exp.silence:
+                print('[run_exps] retry after %s seconds' % backoff)
+            # wake up immediately if sighandler do cleaning and exit()
+            if stop_event.wait(backoff):
+                return False
+            backoff *= 2
+        failures.append([e, nr_attempts, e.failure])
+        return False
+    finally:
+        current_exps.remove(e)
+        progress_keys.pop(e, None)
+
+def pr_failures():
+    if len(failures) == 0:
+        return
+    print('[run_exps] %d experiments failed' % len(failures))
+    for e, nr_attempts, failure in failures:
+        reason = 'failed'
+        if failure != None and failure[0] == 'timeout':
+            reason = '%s timed out' % failure[1]
+        elif failure != None and failure[0] == 'exception':
+            reason = 'raised %s' % failure[1]
+        elif failure != None:
+            reason = 'check "%s" returned %s' % (failure[0], failure[1])
+        print('%s\n\tfailed after %d attempts (%s)' % (
+            exp.pretty(e.main_cmds), nr_attempts, reason))
+
+def run_exps_concurrently(exps, nr_jobs):
+    """Run up to nr_jobs experiments at once.  An experiment starts only if it
+    doesn't conflict with the running ones, e.g., sharing cpus or slot.
+    Experiments are read from the 'exps' iterator only up to nr_jobs ahead."""
+    exps = iter(exps)
+    pending = []
+    running = {}
+    cond = threading.Condition()
+
+    def run(e):
+        try:
+            run_exp(e)
+        finally:
+            # notify even on exceptions, so that the others can continue
+            with cond:
+                del running[e]
+                cond.notify()
+
+    threads = []
+    try:
+        with cond:
+            while True:
+                pending += itertools.islice(exps, nr_jobs * 2 - len(pending))
+                if len(pending) == 0 and len(running) == 0:
+                    break
+                for e in list(pending):
+                    if len(running) >= nr_jobs:
+                        break
+                    if True in [e.conflicts(r) for r in running]:
+                        continue
+                    pending.remove(e)
+                    running[e] = threading.Thread(target=run, args=(e,),
+                            daemon=True)
+                    running[e].start()
+                    threads.append(running[e])
+                cond.wait()
+    finally:
+        # sig_handler() exits from here.  Let the running experiments finish
+        # their cleanup, e.g., restoring env and removing cgroups.
+        for t in threads:
+            t.join()
+
 def sig_handler(signal, frame):
     global current_exps
     global got_sigterm
 
     print('[run_exps] received signal %s' % signal)
     got_sigterm = True
-    for exp in current_exps:
+    stop_event.set()
+    for exp in list(current_exps):
         exp.terminate_tasks()
+    # if experiments are running in threads, those are joined while exiting
     exit(1)
 
 if __name__ == '__main__':
-    RETRY_LIMIT = 10
     parser = argparse.ArgumentParser()
     parser.add_argument('--verbose', '-v', action='store_true',
             help='Make some noisy log')
@@ -95,10 +383,41 @@ if __name__ == '__main__':
             help='Do not print log message at all')
     parser.add_argument('--dryrun', action='store_true',
             help='print what command will be executed only')
+    parser.add_argument('--history', metavar='<file>', action='append',
+            help='journals of previous runs to estimate time for --dryrun')
+    parser.add_argument('--jobs', '-j', type=int, default=1, metavar='<num>',
+            help='number of experiments to run concurrently')
+    parser.add_argument('--no_cgroup', action='store_true',
+            help='do not run each experiment in its own cgroup')
+    parser.add_argument('--kill_grace', type=float, metavar='<seconds>',
+            help='seconds to wait for commands to be terminated by SIGINT')
+    parser.add_argument('--housekeeping_cpus', metavar='<cpulist>',
+            help='cpus to run run_exps.py itself on')
+    parser.add_argument('--direct_exec', action='store_true',
+            help='execute commands having no shell syntax without bash')
+    parser.add_argument('--journal', metavar='<file>',
+            help='record events of the runs in the file as json lines')
+    parser.add_argument('--retry_limit', type=int, default=RETRY_LIMIT,
+            metavar='<num>',
+            help='default max number of attempts for failed experiments')
+    parser.add_argument('--retry_backoff', type=float, default=0,
+            metavar='<seconds>',
+            help='default seconds to wait before the first retry')
+    parser.add_argument('--progress', metavar='<file>',
+            help='record completed experiments in the file')
+    parser.add_argument('--resume', action='store_true',
+            help='skip experiments recorded in the --progress file')
     parser.add_argument('exp_files', metavar='<file>', nargs='+',
             help='experiment spec file')
     args = parser.parse_args()
 
+    if args.resume and args.progress == None:
+        print('--resume requires --progress')
+        exit(1)
+    if args.history != None and not args.dryrun:
+        print('--history requires --dryrun')
+        exit(1)
+
     signal.signal(signal.SIGINT, sig_handler)
     signal.signal(signal.SIGTERM, sig_handler)
 
@@ -107,20 +426,54 @@ if __name__ == '__main__':
         exp.verbose = True
     if args.silence:
         exp.silence = True
+    if args.no_cgroup:
+        exp.use_cgroup = False
+    if args.direct_exec:
+        exp.direct_exec = True
+    RETRY_LIMIT = args.retry_limit
+    retry_backoff = args.retry_backoff
+    if args.kill_grace != None:
+        exp.int_grace = args.kill_grace
+    if args.housekeeping_cpus != None:
+        # commands having no cpus specified should not inherit the affinity
+        exp.default_cpus = os.sched_getaffinity(0)
+        os.sched_setaffinity(0, exp.parse_cpulist(args.housekeeping_cpus))
+    if args.journal != None and not dryrun:
+        journal.open_journal(args.journal)
+    planned_exps = []
+    completed = set()
+    if args.resume:
+        completed = read_progress(args.progress)
+    if args.progress != None and not dryrun:
+        progress_file = open(args.progress, 'a')
 
-    for exp_file in args.exp_files:
-        current_exps = parse_file(exp_file)
+    # find errors in any file before running experiments
+    files_exps = [[exp_file, parse_file(exp_file)]
+            for exp_file in args.exp_files]
+    for exp_file, exps in files_exps:
+        exps = set_progress_keys(exps, exp_file)
+        if args.resume:
+            exps = skip_completed(exps, completed)
         if dryrun:
-            print(current_exps)
+            for e in exps:
+                print(e)
+                progress_keys.pop(e)
+                if args.history != None:
+                    planned_exps.append(e)
+            continue
+
+        if args.jobs > 1:
+            run_exps_concurrently(exps, args.jobs)
             continue
 
-        for exp in current_exps:
-            success = False
-            nr_retry = 0
-            while not success and nr_retry < RETRY_LIMIT:
-                # wait until sighandler do cleaning and exit().
-                if got_sigterm:
-                    time.sleep(1)
-                    continue
-                success = exp.execute()
-                nr_retry += 1
+        for e in exps:
+            run_exp(e)
+
+    if dryrun and args.history != None:
+        planner.pr_plan(planned_exps, planner.read_durations(args.history),
+                args.jobs)
+    journal.close_journal()
+    if not args.silence:
+        pr_failures()
+    if len(failures) > 0:
+        exit(1)
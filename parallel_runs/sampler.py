@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+"Sample resource usage of process trees from /proc"
+
+import os
+import threading
+import time
+
+import proctree
+
+FIELDS = ['time', 'nr_procs', 'utime', 'stime', 'rss_bytes', 'swap_bytes',
+        'minflt', 'majflt', 'read_bytes', 'write_bytes', 'cpu_busy',
+        'cpu_total']
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+def read_proc_io(pid):
+    "Returns read_bytes and write_bytes of the process, or zeros"
+    read_bytes = 0
+    write_bytes = 0
+    try:
+        with open('/proc/%d/io' % pid, 'r') as f:
+            for line in f:
+                if line.startswith('read_bytes:'):
+                    read_bytes = int(line.split()[1])
+                elif line.startswith('write_bytes:'):
+                    write_bytes = int(line.split()[1])
+    except OSError:
+        pass
+    return read_bytes, write_bytes
+
+def read_swap(pid):
+    "Returns VmSwap of the process in bytes"
+    try:
+        with open('/proc/%d/status' % pid, 'r') as f:
+            for line in f:
+                if line.startswith('VmSwap:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+def read_cpu():
+    "Returns busy and total jiffies of the system from /proc/stat"
+    with open('/proc/stat', 'r') as f:
+        fields = [int(x) for x in f.readline().split()[1:]]
+    # user nice system idle iowait irq softirq steal
+    total = sum(fields[:8])
+    return total - fields[3] - fields[4], total
+
+# Indexes of the cumulative counters (utime, stime, minflt, majflt, read_bytes
+# and write_bytes) in the rows of sample()
+COUNTERS = [1, 2, 5, 6, 7, 8]
+
+def sample(pids, history=None):
+    """Returns the resource usage of the processes and their descendants, as a
+    list of FIELDS values except 'time'.  'history' is a dict kept by the
+    caller across the samples of the same trees, if given.  Then the last
+    counters of the processes that exited since the previous sample remain in
+    the cumulative counters, so that those don't decrease."""
+    procs = []
+    for pid in pids:
+        procs += proctree.descendants(pid)
+    row = [0] * (len(FIELDS) - 1)
+    # the pids and the start times of the processes to their counters
+    counters = {}
+    for pid in procs:
+        # stat fields after comm, so the index is the field number - 3
+        fields = proctree.read_stat(pid)
+        if fields == None:
+            continue
+        row[0] += 1
+        row[3] += int(fields[21]) * PAGE_SIZE
+        row[4] += read_swap(pid)
+        read_bytes, write_bytes = read_proc_io(pid)
+        counters[(pid, fields[19])] = [int(fields[11]), int(fields[12]),
+                int(fields[7]), int(fields[9]), read_bytes, write_bytes]
+    if history != None:
+        exited = history.get('exited', [0] * len(COUNTERS))
+        for key, last in history.get('procs', {}).items():
+            if not key in counters:
+                exited = [x + y for x, y in zip(exited, last)]
+        history['exited'] = exited
+        history['procs'] = counters
+        for idx, val in zip(COUNTERS, exited):
+            row[idx] += val
+    for proc_counters in counters.values():
+        for idx, val in zip(COUNTERS, proc_counters):
+            row[idx] += val
+    row[9], row[10] = read_cpu()
+    return row
+
+class Sampler(threading.Thread):
+    """Periodically sample resource usage of process trees into a csv file.
+    'pids_fn' is a function returning the pids of the roots of the trees.
+    Samples are stored in a preallocated buffer of 'nr_slots' rows and
+    written to the file when the buffer is full, or the sampler stops."""
+    def __init__(self, pids_fn, interval, path, nr_slots=256):
+        threading.Thread.__init__(self, daemon=True)
+        self.pids_fn = pids_fn
+        self.interval = interval
+        self.path = path
+        self.rows = [None] * nr_slots
+        self.nr_rows = 0
+        # counters of the processes, for sample()
+        self.history = {}
+        self.stop_event = threading.Event()
+
+    def flush(self, f):
+        for row in self.rows[:self.nr_rows]:
+            f.write(','.join(['%s' % x for x in row]) + '\n')
+        self.nr_rows = 0
+
+    def run(self):
+        dirname = os.path.dirname(self.path)
+        if dirname != '':
+            os.makedirs(dirname, exist_ok=True)
+        start = time.monotonic()
+        with open(self.path, 'w') as f:
+            f.write(','.join(FIELDS) + '\n')
+            while True:
+                now = time.monotonic()
+                self.rows[self.nr_rows] = ['%.3f' % (now - start)] + sample(
+                        self.pids_fn(), self.history)
+                self.nr_rows += 1
+                if self.nr_rows == len(self.rows):
+                    self.flush(f)
+                if self.stop_event.wait(
+                        max(0, self.interval - (time.monotonic() - now))):
+                    break
+            self.flush(f)
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+"""
+Run commands on remote hosts over persistent ssh connections
+
+Connections are multiplexed by the ControlMaster feature of OpenSSH.  The
+first command to a host makes a master connection, which persists in
+background, and following commands to the host reuse it without the
+handshake.  Because the commands run in the batch mode, authentication should
+be done without passwords, e.g., using public keys.
+
+SshPool keeps the connections to multiple hosts, and runs commands on the
+hosts in parallel.  Multiple commands can be sent to a host as a batch, which
+runs those one by one in a single remote shell and collects the exit code of
+each command.
+"""
+
+import os
+import re
+import secrets
+import shlex
+import shutil
+import subprocess
+import tempfile
+import threading
+
+# ssh program to use.  A compatible stand-in could be used for tests.
+ssh_cmd = 'ssh'
+# Seconds to keep idle master connections
+persist_seconds = 600
+# Seconds to wait for the connection to hosts
+connect_timeout = 10
+
+control_dir = None
+
+def parse_destination(destination):
+    "Parse '[<user>@]<host>[:<port>]' into '[<user>@]<host>' and the port"
+    if ':' in destination:
+        destination, port = destination.rsplit(':', 1)
+        return destination, int(port)
+    return destination, None
+
+def cleanup():
+    """Remove the directory of the control sockets.  Connections should be
+    closed before."""
+    global control_dir
+    if control_dir != None:
+        shutil.rmtree(control_dir, ignore_errors=True)
+        control_dir = None
+
+class SshConnection:
+    "Multiplexed ssh connection to a host"
+    def __init__(self, destination, port=None):
+        global control_dir
+        self.destination = destination
+        self.port = port
+        self.lock = threading.Lock()
+        self.opened = False
+        if control_dir == None:
+            # unix socket paths should be short, so don't use the cwd
+            control_dir = tempfile.mkdtemp(prefix='lazybox-ssh-')
+
+    def __str__(self):
+        if self.port == None:
+            return self.destination
+        return '%s:%s' % (self.destination, self.port)
+
+    def ssh_args(self):
+        args = shlex.split(ssh_cmd) + ['-o', 'ControlMaster=auto',
+                '-o', 'ControlPath=%s' % os.path.join(control_dir, '%C'),
+                '-o', 'ControlPersist=%d' % persist_seconds,
+                '-o', 'ConnectTimeout=%d' % connect_timeout,
+                '-o', 'BatchMode=yes']
+        if self.port != None:
+            args += ['-p', '%d' % self.port]
+        return args
+
+    def open(self):
+        """Make the master connection, so that following commands, including
+        concurrent ones, share it.  Returns whether the host is reachable."""
+        with self.lock:
+            if not self.opened:
+                self.opened = self.call('true', stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL) == 0
+            return self.opened
+
+    def popen(self, cmd, **kwargs):
+        "Start the command on the host.  'kwargs' are for subprocess.Popen()"
+        return subprocess.Popen(self.ssh_args() + [self.destination, cmd],
+                **kwargs)
+
+    def call(self, cmd, **kwargs):
+        "Returns the exit code of the command, or 255 for ssh errors"
+        return self.popen(cmd, **kwargs).wait()
+
+    def output(self, cmd):
+        "Returns the exit code and the stdout of the command"
+        popn = self.popen(cmd, stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE)
+        out = popn.communicate()[0]
+        return popn.returncode, out.decode()
+
+    def batch(self, cmds, sudo=False):
+        """Run the commands one by one in a remote shell.  Returns a list of
+        [exit code, output] of each command.  Commands after a failure still
+        run.  If the host is not reachable, exit codes of all are 255.  If
+        'sudo' is True, the shell runs with 'sudo -n'."""
+        marker = 'lazybox-batch-%s' % secrets.token_hex(8)
+        script = ''.join(['(%s\n) 2>&1; printf \'\\n%s %d %%d\\n\' $?\n' % (
+            cmd, marker, i) for i, cmd in enumerate(cmds)])
+        if sudo:
+            script = 'sudo -n bash -c %s' % shlex.quote(script)
+        ret, out = self.output(script)
+        results = [[255, ''] for cmd in cmds]
+        # outputs of the commands are followed by '\n<marker> <index> <code>'
+        pos = 0
+        for m in re.finditer(r'\n%s (\d+) (\d+)\n' % marker, out):
+            results[int(m.group(1))] = [int(m.group(2)), out[pos:m.start()]]
+            pos = m.end()
+        if ret == 255 and pos == 0:
+            results[0][1] = out
+        return results
+
+    def close(self):
+        "Close the master connection"
+        with self.lock:
+            subprocess.call(self.ssh_args() + ['-O', 'exit', self.destination],
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            self.opened = False
+
+class SshPool:
+    "Connections to multiple hosts, which are made on the first use"
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = {}
+
+    def get(self, host):
+        "Returns the connection to the '[<user>@]<host>[:<port>]'"
+        with self.lock:
+            if not host in self.connections:
+                self.connections[host] = SshConnection(
+                        *parse_destination(host))
+            return self.connections[host]
+
+    def batch(self, hosts, cmds, sudo=False):
+        """Run the batch of the commands on the hosts in parallel.  Returns a
+        dict of the hosts to the results of SshConnection.batch()."""
+        results = {}
+        def run(host):
+            conn = self.get(host)
+            if not conn.open():
+                results[host] = [[255, 'ssh: %s not reachable\n' % host]
+                        for cmd in cmds]
+                return
+            results[host] = conn.batch(cmds, sudo)
+        threads = [threading.Thread(target=run, args=(host,))
+                for host in hosts]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def close(self):
+        with self.lock:
+            for conn in self.connections.values():
+                conn.close()
+            self.connections = {}
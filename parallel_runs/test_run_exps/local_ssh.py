@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+
+"""
+A stand-in of ssh for tests of remote experiments.  Runs the command on the
+local machine instead of the destination, ignoring the options.  Control
+commands ('-O <command>') do nothing.  Destinations starting with 'down' are
+treated as not reachable.
+"""
+
+import os
+import sys
+
+OPTS_WITH_ARG = 'BbcDEeFIiJLlmOopQRSWw'
+
+args = sys.argv[1:]
+control = False
+while len(args) > 0 and args[0].startswith('-'):
+    opt = args.pop(0)
+    if opt == '--':
+        break
+    if opt == '-O':
+        control = True
+    if opt[-1] in OPTS_WITH_ARG and len(opt) == 2:
+        args.pop(0)
+if control:
+    exit(0)
+if len(args) < 2:
+    print('usage: %s [option]... <destination> <command>' % sys.argv[0])
+    exit(255)
+if args[0].split('@')[-1].startswith('down'):
+    print('ssh: connect to host %s: Connection refused' % args[0],
+            file=sys.stderr)
+    exit(255)
+os.execvp('bash', ['bash', '-c', ' '.join(args[1:])])
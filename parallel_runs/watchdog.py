@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+"Call functions when their deadlines pass, from a thread"
+
+import itertools
+import threading
+import time
+import traceback
+
+class Watchdog(threading.Thread):
+    """A thread calling registered functions when their timeouts pass.  The
+    thread sleeps until the nearest deadline, or a change of the deadlines."""
+    def __init__(self):
+        threading.Thread.__init__(self, daemon=True)
+        self.cond = threading.Condition()
+        self.ids = itertools.count()
+        # id to [deadline, function]
+        self.timers = {}
+        self.stopped = False
+
+    def add(self, timeout, fn):
+        "Call 'fn' after 'timeout' seconds.  Returns an id of the timer."
+        with self.cond:
+            timer_id = next(self.ids)
+            self.timers[timer_id] = [time.monotonic() + timeout, fn]
+            self.cond.notify()
+        return timer_id
+
+    def remove(self, timer_id):
+        with self.cond:
+            self.timers.pop(timer_id, None)
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        self.join()
+
+    def run(self):
+        with self.cond:
+            while not self.stopped:
+                now = time.monotonic()
+                expired = [i for i in self.timers if self.timers[i][0] <= now]
+                if len(expired) == 0:
+                    timeout = None
+                    if len(self.timers) > 0:
+                        deadline = min([t[0] for t in self.timers.values()])
+                        timeout = deadline - now
+                    self.cond.wait(timeout)
+                    continue
+                fns = [self.timers.pop(i)[1] for i in expired]
+                # the functions could add or remove timers
+                self.cond.release()
+                try:
+                    for fn in fns:
+                        try:
+                            fn()
+                        except Exception:
+                            # keep running for the other timers
+                            print('[watchdog] timer function failed')
+                            traceback.print_exc()
+                finally:
+                    self.cond.acquire()
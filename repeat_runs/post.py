@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+program_decr = """
+Parse the raw outputs of the repeated runs and make statistics of those, as
+_parse.sh and _stat.sh do for each directory.  The results tree is scanned
+once, and the parsers of each repeated run directory and the statists of each
+variant directory run in parallel, up to '--jobs' directories at once.
+A manifest file in each variant directory keeps the hashes of the inputs
+(raw or parsed outputs, and the parsers or the statists) that each parser and
+statist processed last time, and of the outputs it made, so only the scripts
+having new or modified inputs, or removed or modified outputs, run again.
+"""
+
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import os
+import subprocess
+import threading
+
+CONFIG_VARS = ['EXPERIMENTS', 'VARIANTS', 'PARSED', 'ODIR_ROOT',
+        'parsers_dir', 'statists_dir']
+MANIFEST = 'post_manifest.json'
+
+def read_config(bindir):
+    "Returns values of the config variables, by sourcing __common.sh"
+    common = os.path.join(bindir, '__common.sh')
+    # values could have newlines, but not NUL
+    script = 'source "$0"; for v in %s; do printf \'%%s\\0\' "${!v}"; done' % (
+            ' '.join(CONFIG_VARS))
+    out = subprocess.check_output(['bash', '-c', script, common])
+    return dict(zip(CONFIG_VARS, out.decode().split('\0')))
+
+def is_repeat_dir(name):
+    return len(name) == 2 and name.isdigit()
+
+def matching_scripts(scripts_dir, names):
+    """Returns a dict of the scripts in the directory of which names start
+    with any of the names, to the matched names"""
+    ret = {}
+    for script in sorted(os.listdir(scripts_dir)):
+        matched = [name for name in sorted(names) if script.startswith(name)]
+        if len(matched) > 0:
+            ret[script] = matched
+    return ret
+
+def snapshot(directory):
+    "Returns a dict of the files under the directory to their mtimes and sizes"
+    ret = {}
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            ret[path] = [st.st_mtime_ns, st.st_size]
+    return ret
+
+def made_files(before, after):
+    "Returns the files that are created or modified between the snapshots"
+    return [path for path in sorted(after) if before.get(path) != after[path]]
+
+def sha256_of(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+class Manifest:
+    """Hashes of the inputs that each parser and statist of a variant
+    directory processed last time, and of the outputs that it made, kept in the
+    variant directory.  The hash
+    of each file is cached with its mtime and size, so only new or modified
+    files are read for hashing.  If 'force' is True, every run is treated
+    as changed."""
+    def __init__(self, variant_dir, force=False):
+        self.root = variant_dir
+        self.force = force
+        self.path = os.path.join(variant_dir, MANIFEST)
+        self.lock = threading.Lock()
+        # path to [mtime_ns, size, hash]
+        self.files = {}
+        # '<kind>:<key>' to the signature and the outputs of the last
+        # successful run
+        self.runs = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                content = json.load(f)
+            self.files = content['files']
+            self.runs = content['runs']
+
+    def digest(self, path):
+        "Returns the hash of the file, or None if it is not a file"
+        key = os.path.relpath(path, self.root)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if not os.path.isfile(path):
+            return None
+        with self.lock:
+            cached = self.files.get(key)
+        if cached != None and cached[:2] == [st.st_mtime_ns, st.st_size]:
+            return cached[2]
+        digest = sha256_of(path)
+        with self.lock:
+            self.files[key] = [st.st_mtime_ns, st.st_size, digest]
+        return digest
+
+    def signature(self, script, inputs):
+        """Returns the signature of a run of the script for the inputs, which
+        is keyed by the hash of the script"""
+        return {'script': self.digest(script),
+                'inputs': {os.path.relpath(p, self.root): self.digest(p)
+                    for p in inputs}}
+
+    def changed(self, key, signature):
+        """Returns True if the signature is different from that of the last
+        successful run, or an output of the run is removed or modified"""
+        with self.lock:
+            last = self.runs.get(key)
+        if self.force or last == None:
+            return True
+        if [last['script'], last['inputs']] != [signature['script'],
+                signature['inputs']]:
+            return True
+        for path, digest in last.get('outputs', {}).items():
+            if self.digest(os.path.join(self.root, path)) != digest:
+                return True
+        return False
+
+    def record(self, key, signature, outputs):
+        "Record the successful run of the signature, which made the outputs"
+        record = dict(signature, outputs={os.path.relpath(p, self.root):
+            self.digest(p) for p in outputs})
+        with self.lock:
+            self.runs[key] = record
+
+    def save(self):
+        with self.lock:
+            content = json.dumps({'files': self.files, 'runs': self.runs},
+                    sort_keys=True)
+        # write and rename, so that a crash doesn't leave a partial file
+        with open(self.path + '.tmp', 'w') as f:
+            f.write(content)
+        os.rename(self.path + '.tmp', self.path)
+
+def run_script(path, args):
+    "Returns whether the script succeeded"
+    ret = subprocess.call([path] + args)
+    if ret != 0:
+        print('%s %s returned %d' % (path, ' '.join(args), ret))
+    return ret == 0
+
+def parse(config, manifest, parsers_dir, raw_dir):
+    """Run the parsers of which matching raw outputs in the directory or the
+    parsers themselves are changed since their last successful run.  Returns
+    the number of the parsers that ran."""
+    parsed_dir = os.path.join(raw_dir, config['PARSED'])
+    raw_outputs = [f for f in os.listdir(raw_dir) if f != config['PARSED']]
+    todo = []
+    for parser, matched in matching_scripts(parsers_dir, raw_outputs).items():
+        path = os.path.join(parsers_dir, parser)
+        key = 'parse:%s/%s' % (os.path.basename(raw_dir), parser)
+        signature = manifest.signature(path,
+                [os.path.join(raw_dir, m) for m in matched])
+        if manifest.changed(key, signature):
+            todo.append([path, key, signature])
+    # stat() lists the parsed dir even if no parser matched
+    os.makedirs(parsed_dir, exist_ok=True)
+    if len(todo) == 0:
+        return 0
+    print('parse %s' % raw_dir)
+    for path, key, signature in todo:
+        before = snapshot(parsed_dir)
+        if run_script(path, [raw_dir, parsed_dir]):
+            manifest.record(key, signature,
+                    made_files(before, snapshot(parsed_dir)))
+    return len(todo)
+
+def stat(config, manifest, statists_dir, variant_dir):
+    """Run the statists of which matching parsed outputs of the repeated runs
+    or the statists themselves are changed since their last successful run.
+    Returns the number of the statists that ran."""
+    parsed_dirs = [os.path.join(variant_dir, d, config['PARSED'])
+            for d in sorted(os.listdir(variant_dir)) if is_repeat_dir(d)]
+    if len(parsed_dirs) == 0:
+        print('no raw input dir in %s' % variant_dir)
+        return 0
+    stat_dir = os.path.join(variant_dir, 'stat')
+    todo = []
+    for statist, matched in matching_scripts(statists_dir,
+            os.listdir(parsed_dirs[0])).items():
+        path = os.path.join(statists_dir, statist)
+        key = 'stat:%s' % statist
+        signature = manifest.signature(path, [os.path.join(d, m)
+            for d in parsed_dirs for m in matched])
+        if manifest.changed(key, signature):
+            todo.append([path, key, signature])
+    if len(todo) == 0:
+        return 0
+    os.makedirs(stat_dir, exist_ok=True)
+    print('stat %s' % parsed_dirs[0])
+    for path, key, signature in todo:
+        before = snapshot(stat_dir)
+        if run_script(path, [stat_dir + '/', ' '.join(parsed_dirs)]):
+            manifest.record(key, signature,
+                    made_files(before, snapshot(stat_dir)))
+    return len(todo)
+
+def scripts_dir_of(config, exp, kind):
+    if config['%s_dir' % kind] != '':
+        return config['%s_dir' % kind]
+    return os.path.join(exp, kind)
+
+def variant_dirs(config):
+    "Yield [experiment, variant directory] of the results tree"
+    for exp in config['EXPERIMENTS'].split():
+        for variant in config['VARIANTS'].split():
+            variant_dir = os.path.join(config['ODIR_ROOT'],
+                    os.path.basename(exp), variant)
+            if os.path.isdir(variant_dir):
+                yield exp, variant_dir
+
+def post(config, nr_jobs, force=False):
+    """Parse all repeated run directories, and then make the statistics of all
+    variant directories.  'config' is the values of CONFIG_VARS.  If 'force'
+    is True, all scripts run.  Returns the numbers of the parsers and the
+    statists that ran."""
+    manifests = {}
+    with concurrent.futures.ThreadPoolExecutor(nr_jobs) as executor:
+        parses = []
+        for exp, variant_dir in variant_dirs(config):
+            manifests[variant_dir] = Manifest(variant_dir, force)
+            for d in sorted(os.listdir(variant_dir)):
+                if is_repeat_dir(d):
+                    parses.append(executor.submit(parse, config,
+                        manifests[variant_dir],
+                        scripts_dir_of(config, exp, 'parsers'),
+                        os.path.join(variant_dir, d)))
+        nr_parsers = sum([p.result() for p in parses])
+        for manifest in manifests.values():
+            manifest.save()
+
+        stats = [executor.submit(stat, config, manifests[variant_dir],
+            scripts_dir_of(config, exp, 'statists'), variant_dir)
+            for exp, variant_dir in variant_dirs(config)]
+        nr_statists = sum([s.result() for s in stats])
+        for manifest in manifests.values():
+            manifest.save()
+    return nr_parsers, nr_statists
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=program_decr,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count(),
+            metavar='<num>', help='number of directories to process at once')
+    parser.add_argument('--force', action='store_true',
+            help='run all scripts even if their inputs are not changed')
+    args = parser.parse_args()
+
+    config = read_config(os.path.dirname(os.path.abspath(__file__)))
+    nr_parsers, nr_statists = post(config, args.jobs, args.force)
+    print('%d parsers and %d statists ran' % (nr_parsers, nr_statists))
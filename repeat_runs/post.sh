@@ -1,27 +1,8 @@
 #!/bin/bash
 
-BINDIR=$(dirname "$0")
-
-source "$BINDIR/__common.sh"
+# Parsing and stat of the results are done by post.py.  _parse.sh and _stat.sh
+# can still be used for a single directory.
 
-for exp in $EXPERIMENTS
-do
-	exp_basename=$(basename "$exp")
-	for v in $VARIANTS
-	do
-		for d in "$ODIR_ROOT/$exp_basename/$v/"[0-9][0-9]
-		do
-			"$BINDIR"/_parse.sh "$exp" "$d"
-		done
-	done
-done
+BINDIR=$(dirname "$0")
 
-for exp in $EXPERIMENTS
-do
-	exp_basename=$(basename "$exp")
-	for v in $VARIANTS
-	do
-		ODIR="$ODIR_ROOT/$exp_basename/$v"
-		"$BINDIR/"_stat.sh "$exp" "$ODIR"
-	done
-done
+exec "$BINDIR/post.py" "$@"
@@ -44,6 +44,9 @@ def write_fs(root, contents):
             except Exception as e:
                 print('failed writing %s to %s (%s)' % (
                     contents[filename], filepath, e))
+        elif isinstance(contents[filename], str):
+            print('failed writing %s to %s (no such file)' % (
+                contents[filename], filepath))
         else:
             write_fs(filepath, contents[filename])
 
@@ -9,10 +9,10 @@ parser.add_argument('pid', metavar='<pid>', type=int, help='process id')
 args = parser.parse_args()
 
 fpath = os.path.realpath(os.path.dirname(__file__))
-sys.path.append(fpath + '/../')
-import exp
+sys.path.append(fpath + '/../parallel_runs/')
+import proctree
 
 pid = args.pid
 
-for pid in exp.childs_of(pid, False, print_tree=False):
+for pid in proctree.descendants(pid):
     print(pid)